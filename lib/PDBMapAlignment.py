@@ -14,11 +14,29 @@
 #=============================================================================#
 
 # See main check for cmd line parsing
-import sys,os,csv
+import sys,os,csv,sqlite3,hashlib,cPickle
+from collections import OrderedDict
+import numpy as np
 from Bio import pairwise2
 from Bio.SubsMat import MatrixInfo as matlist
 
 class PDBMapAlignment():
+  # Dense BLOSUM62 substitution matrix, built on first use
+  _alphabet = None
+  _matrix   = None
+  # Alignment cache, keyed on a hash of the gapped chain sequence, its
+  # start offset, and the transcript ID and sequence, together with the
+  # aligner version and scoring. Recent results are held in memory (LRU);
+  # all results persist in an optional SQLite store.
+  # Increment ALIGNER_VERSION whenever alignment or scoring changes, so that
+  # stored alignments from earlier versions are no longer used.
+  ALIGNER_VERSION = 2
+  aln_cache   = OrderedDict()
+  CACHE_MAX_ENTRIES = 1000
+  cache_stats = {'hits':0,'misses':0}
+  store_fname = None
+  _store_con  = None
+  _store_pid  = None
 
   def __init__(self,chain,transcript,io=None):
     """ Alignment of PDBMapStructure chain to PDBMapAlignment """
@@ -62,31 +80,30 @@ class PDBMapAlignment():
     gap_extend = -0.5
     matrix     = matlist.blosum62
     if io:
-        q  = "SELECT resnum,uniprot_resnum,uniprot_acc FROM sifts WHERE pdbid=%s "
-        q += "AND chain=%s AND uniprot_acc=%s ORDER BY resnum"
-        res = io.secure_query(q,
-            (chain.get_parent().get_parent().id,chain.id,transcript.protein),
-            cursorclass='Cursor')
-        res = [r for r in res] # convert generator to list
+        # SIFTS rows are fetched once per structure by the io object
+        res = io.sifts_alignment(chain.get_parent().get_parent().id,
+                                  chain.id,transcript.protein)
         if len(res) > 0:
             # A SIFTS alignment is available
-            resis = [r.id[1] for r in chain.get_residues()]
-            n = float(len(resis))
+            resis = set(r.id[1] for r in chain.get_residues())
+            n = float(len([r for r in chain.get_residues()]))
             # Only align residues in the structure
             pdb2seq       = dict((r[0],r[1]) for r in res if r[0] in resis)
             seq2pdb       = dict((r[1],r[0]) for r in res if r[0] in resis)
+            # Residue number arrays, in chain order; unmapped residues are -1
+            cids = sorted(pdb2seq)
+            tids = np.array([-1 if pdb2seq[c] is None else pdb2seq[c] for c in cids],dtype=np.intp)
+            cids = np.array(cids,dtype=np.intp)
+            valid = (cids > 0) & (cids < len(c_seq)) & (tids > 0) & (tids < len(t_seq))
+            c_res = np.array(c_seq)[cids[valid]]
+            t_res = np.array(t_seq)[tids[valid]]
             # Aligned residues over total residues in chain
             perc_aligned  = min(len(pdb2seq) / n, 1.)
-            perc_identity = min(len([1 for cid,tid in pdb2seq.iteritems() if
-                                    0 < cid < len(c_seq) and 0 < tid < len(t_seq)
-                                    and c_seq[cid]==t_seq[tid]]) / n,1.)
-            aln_str = [(cid,c_seq[cid],tid,t_seq[tid]) for cid,tid in pdb2seq.iteritems() if
-                                    0 < cid < len(c_seq) and 0 < tid < len(t_seq)]
-            aln_chain = ''.join([r[1] for r in aln_str])
-            aln_trans = ''.join([r[3] for r in aln_str])
+            perc_identity = min((c_res == t_res).sum() / n, 1.)
+            aln_chain = ''.join(c_res)
+            aln_trans = ''.join(t_res)
             aln_str   = "<sifts>\n%s\n%s"%(aln_chain,aln_trans)
-            aln_score = pairwise2.align.globalds(aln_chain.replace('-','X'),aln_trans.replace('-','X'),
-                                        matrix,gap_open,gap_extend,score_only=True)
+            aln_score = self._rescore(aln_chain,aln_trans,gap_open,gap_extend)
             if perc_identity >= 0.85:
                 # Successfully aligned with SIFTS. Do not continue processing.
                 return pdb2seq,seq2pdb,aln_str,aln_score,perc_aligned,perc_identity
@@ -110,16 +127,25 @@ class PDBMapAlignment():
     # Record the gaps
     c_gap = [i+c_start for i,r in enumerate(c_seq) if r == '-']
     c_seq = ''.join(c_seq) # Convert to string
-    c_seq = c_seq.replace('-','X') # Dummy code sequence gaps to X
     t_gap = [i+t_start for i,r in enumerate(t_seq) if r == '-']
     t_seq = ''.join(t_seq) # Convert to string
+    # Identical chains aligned to the same transcript skip realignment
+    key = hashlib.sha1("%s|%d|%s|%s|%d|v%d|blosum62|%g|%g"%(c_seq,c_start,
+                        transcript.transcript,t_seq,t_start,
+                        PDBMapAlignment.ALIGNER_VERSION,gap_open,gap_extend)).hexdigest()
+    cached = PDBMapAlignment.cache_get(key)
+    if cached:
+      return cached
+    c_seq = c_seq.replace('-','X') # Dummy code sequence gaps to X
     t_seq = t_seq.replace('-','X') # Dummy code sequence gaps to X
     # # Generate transcript/protein sequence
 
     # Perform pairwise alignment
-    alignment = pairwise2.align.globalds(c_seq,t_seq,matrix,
-                    gap_open,gap_extend,one_alignment_only=True)
-    aln_chain, aln_trans, aln_score, begin, end = alignment[0]
+    alignment = self._align_global(c_seq,t_seq,gap_open,gap_extend)
+    if not alignment: # residue codes outside the substitution matrix
+      alignment = pairwise2.align.globalds(c_seq,t_seq,matrix,
+                    gap_open,gap_extend,one_alignment_only=True)[0]
+    aln_chain, aln_trans, aln_score = alignment[:3]
 
     # Create an alignment map from chain to transcript
     c_ind = [x for x in self._gap_shift(aln_chain,c_start,c_gap)]
@@ -138,8 +164,7 @@ class PDBMapAlignment():
     aln_trans = ''.join(['-' if not t_ind[i] or t_ind[i]+t_start in t_gap else s for i,s in enumerate(aln_trans)])
     aln_str = "%s\n%s"%(aln_chain,aln_trans)
     # Rescore alignment without excess transcript sequence
-    aln_score = pairwise2.align.globalds(aln_chain.replace('-','X'),aln_trans.replace('-','X'),
-                                        matrix,gap_open,gap_extend,score_only=True)
+    aln_score = self._rescore(aln_chain,aln_trans,gap_open,gap_extend)
 
     # Determine final alignment from chain -> transcript/protein
     pdb2seq = dict((c_ind[i],t_ind[i]) for i in 
@@ -158,7 +183,225 @@ class PDBMapAlignment():
     # Percent of the original identical to transcript
     perc_identity = float(matched) / clen
 
-    return pdb2seq,seq2pdb,aln_str,aln_score,perc_aligned,perc_identity
+    result = pdb2seq,seq2pdb,aln_str,aln_score,perc_aligned,perc_identity
+    PDBMapAlignment.cache_put(key,result)
+    return result
+
+  @classmethod
+  def use_store(cls,fname):
+    """ Enables the persistent alignment store """
+    store_dir = os.path.dirname(fname)
+    if store_dir and not os.path.exists(store_dir):
+      os.makedirs(store_dir)
+    PDBMapAlignment.store_fname = fname
+    PDBMapAlignment._store_con  = None
+
+  @classmethod
+  def _store(cls):
+    """ Returns this process's connection to the alignment store """
+    if not PDBMapAlignment.store_fname:
+      return None
+    if PDBMapAlignment._store_pid != os.getpid() or not PDBMapAlignment._store_con:
+      # SQLite connections must not be shared across forked workers
+      con = sqlite3.connect(PDBMapAlignment.store_fname,timeout=300)
+      con.text_factory = str
+      con.execute("""CREATE TABLE IF NOT EXISTS Alignment (
+                     aln_key TEXT PRIMARY KEY,
+                     result BLOB NOT NULL)""")
+      con.commit()
+      PDBMapAlignment._store_con = con
+      PDBMapAlignment._store_pid = os.getpid()
+    return PDBMapAlignment._store_con
+
+  @classmethod
+  def cache_get(cls,key):
+    """ Returns the cached alignment result for this key, or None """
+    cache = PDBMapAlignment.aln_cache
+    if key in cache:
+      result = cache.pop(key)
+      cache[key] = result # most recently used
+      PDBMapAlignment.cache_stats['hits'] += 1
+      return result
+    con = PDBMapAlignment._store()
+    if con:
+      row = con.execute("SELECT result FROM Alignment WHERE aln_key=?",(key,)).fetchone()
+      if row:
+        result = cPickle.loads(str(row[0]))
+        PDBMapAlignment._cache_add(key,result)
+        PDBMapAlignment.cache_stats['hits'] += 1
+        return result
+    PDBMapAlignment.cache_stats['misses'] += 1
+    return None
+
+  @classmethod
+  def cache_put(cls,key,result):
+    """ Caches an alignment result in memory and in the store """
+    PDBMapAlignment._cache_add(key,result)
+    con = PDBMapAlignment._store()
+    if con:
+      blob = sqlite3.Binary(cPickle.dumps(result,cPickle.HIGHEST_PROTOCOL))
+      con.execute("INSERT OR REPLACE INTO Alignment VALUES (?,?)",(key,blob))
+      con.commit()
+
+  @classmethod
+  def _cache_add(cls,key,result):
+    """ Adds a result to the in-memory LRU """
+    cache = PDBMapAlignment.aln_cache
+    cache[key] = result
+    while len(cache) > PDBMapAlignment.CACHE_MAX_ENTRIES:
+      cache.popitem(last=False)
+
+  @classmethod
+  def _score_matrix(cls):
+    """ Returns the residue index and dense BLOSUM62 matrix """
+    if PDBMapAlignment._matrix is None:
+      blosum = matlist.blosum62
+      alphabet = dict((c,i) for i,c in enumerate(sorted(set(c for k in blosum for c in k))))
+      matrix = np.zeros((len(alphabet),len(alphabet)))
+      for (a,b),s in blosum.iteritems():
+        matrix[alphabet[a],alphabet[b]] = s
+        matrix[alphabet[b],alphabet[a]] = s
+      PDBMapAlignment._alphabet = alphabet
+      PDBMapAlignment._matrix   = matrix
+    return PDBMapAlignment._alphabet,PDBMapAlignment._matrix
+
+  def _encode(self,seq):
+    """ Encodes a sequence as matrix indices. None if any residue is unscored. """
+    alphabet,matrix = self._score_matrix()
+    try:
+      return np.array([alphabet[c] for c in seq],dtype=np.intp)
+    except KeyError:
+      return None
+
+  def _align_global(self,seqA,seqB,gap_open,gap_extend):
+    """ Affine-gap global alignment (Gotoh), vectorized over each row.
+        Scores as pairwise2.align.globalds with BLOSUM62 and penalized
+        end gaps, and breaks ties as pairwise2 does, so that the same
+        alignment is returned. Returns (alnA,alnB,score), or None if a
+        residue is not in the substitution matrix. """
+    alphabet,matrix = self._score_matrix()
+    a,b = self._encode(seqA),self._encode(seqB)
+    if a is None or b is None or not len(a) or not len(b):
+      return None
+    n,m = len(a),len(b)
+    k   = np.arange(m+1)
+    # Best score per cell (S) and pairwise2's traceback bits (T):
+    # 1 open gap in seqA, 2 match, 4 open gap in seqB, 8 extend gap in
+    # seqA, 16 extend gap in seqB. The border has no traceback.
+    S = np.zeros((n+1,m+1))
+    T = np.zeros((n+1,m+1),dtype=np.uint8)
+    S[0,1:] = gap_open + (k[1:]-1)*gap_extend
+    S[1:,0] = gap_open + (np.arange(1,n+1)-1)*gap_extend
+    # Gap in seqB (consumes seqA), initialized as in pairwise2
+    Ix = 2*gap_open + (k-1)*gap_extend; Ix[0] = 0.
+    for i in xrange(1,n+1):
+      # Match/mismatch from the previous row's diagonal
+      M = np.empty(m+1); M[0] = -np.inf
+      M[1:] = S[i-1,:-1] + matrix[a[i-1]][b]
+      # Gap in seqB from the previous row
+      ix_open = S[i-1] + gap_open
+      ix_extd = Ix + gap_extend
+      Ix = np.maximum(ix_open,ix_extd)
+      # Gap in seqA (consumes seqB[j-1]) along this row. The best opening
+      # column is found with a running maximum rather than a scalar loop.
+      mix = np.maximum(M,Ix); mix[0] = S[i,0]
+      P   = np.maximum.accumulate(mix - k*gap_extend)
+      Iy  = np.empty(m+1); Iy[0] = 2*gap_open + (i-1)*gap_extend
+      Iy[1:] = np.maximum(Iy[0] + k[1:]*gap_extend,
+                          gap_open + (k[1:]-1)*gap_extend + P[:-1])
+      best = np.maximum(np.maximum(M,Ix),Iy); best[0] = S[i,0]
+      S[i] = best
+      iy_open = best[:-1] + gap_open
+      iy_extd = Iy[:-1] + gap_extend
+      iy,ix,bst = Iy[1:],Ix[1:],best[1:]
+      iy_bits = np.where(iy_open == iy,1,0) + np.where(iy_extd == iy,8,0)
+      ix_bits = np.where(ix_open[1:] == ix,4,0) + np.where(ix_extd[1:] == ix,16,0)
+      T[i,1:] = np.where(M[1:] == bst,2,0) + np.where(iy == bst,iy_bits,0) \
+                  + np.where(ix == bst,ix_bits,0)
+    aln = self._traceback(seqA,seqB,S,T,gap_open,gap_extend)
+    if not aln:
+      return None
+    return aln[0],aln[1],float(S[n,m])
+
+  def _traceback(self,seqA,seqB,S,T,gap_open,gap_extend):
+    """ Recovers the first alignment found by pairwise2's backtrace: a
+        depth-first search taking the lowest traceback bit first, never
+        following a gap in seqB with a gap in seqA, and preferring the
+        longest of equally scored gap extensions. Returns (alnA,alnB) or
+        None if every path is a dead end. """
+    gap   = lambda l: gap_open + (l-1)*gap_extend
+    stack = [('','',len(seqA),len(seqB),False,T[-1,-1])]
+    while stack:
+      alnA,alnB,row,col,col_gap,trace = stack.pop()
+      dead_end = False
+      while (row > 0 or col > 0) and not dead_end:
+        cache = (alnA,alnB,row,col,col_gap)
+        if not trace:
+          # Border reached; the rest of the sequences align to gaps
+          if col and col_gap:
+            dead_end = True
+          else:
+            alnA += seqA[row-1::-1] if row else ''
+            alnB += seqB[col-1::-1] if col else ''
+            alnA += '-'*(len(alnB)-len(alnA))
+            alnB += '-'*(len(alnA)-len(alnB))
+          break
+        elif trace % 2 == 1: # open gap in seqA
+          trace -= 1
+          if col_gap:
+            dead_end = True
+          else:
+            col -= 1
+            alnA += '-'; alnB += seqB[col]
+        elif trace % 4 == 2: # match
+          trace -= 2
+          row,col = row-1,col-1
+          alnA += seqA[row]; alnB += seqB[col]
+          col_gap = False
+        elif trace % 8 == 4: # open gap in seqB
+          trace -= 4
+          row -= 1
+          alnA += seqA[row]; alnB += '-'
+          col_gap = True
+        elif trace in (8,24) or trace == 16: # extend a gap
+          horiz  = trace != 16
+          trace -= 8 if horiz else 16
+          if horiz and col_gap:
+            dead_end = True
+          else:
+            col_gap = not horiz
+            # Every equally scored opening is a branch; the walk itself
+            # always ends at the border, so the longest gap is tried first
+            target = S[row,col]
+            for l in xrange(1,(col if horiz else row)+1):
+              if horiz:
+                col -= 1
+                alnA += '-'; alnB += seqB[col]
+              else:
+                row -= 1
+                alnA += seqA[row]; alnB += '-'
+              if l > 1 and S[row,col] + gap(l) == target:
+                if not T[row,col]:
+                  break
+                stack.append((alnA,alnB,row,col,col_gap,T[row,col]))
+            if not T[row,col]:
+              dead_end = True
+        if trace: # another path to follow
+          stack.append(cache+(trace,))
+        trace = T[row,col]
+      if not dead_end:
+        return alnA[::-1],alnB[::-1]
+    return None
+
+  def _rescore(self,alnA,alnB,gap_open,gap_extend):
+    """ Scores an existing alignment column by column, gaps scored as X """
+    a = self._encode(alnA.replace('-','X'))
+    b = self._encode(alnB.replace('-','X'))
+    if a is None or b is None:
+      return pairwise2.align.globalds(alnA.replace('-','X'),alnB.replace('-','X'),
+                          matlist.blosum62,gap_open,gap_extend,score_only=True)
+    alphabet,matrix = self._score_matrix()
+    return float(matrix[a,b].sum())
 
   def _gap_shift(self,seq,seq_start,gaps=[]):
     """ Support generator function for align """
@@ -0,0 +1,167 @@
+#!/usr/bin/env python2.7
+#
+# Project        : PDBMap
+# Filename       : PDBMapColumnStore.py
+# Author         : agent
+# Organization   : Center for Human Genetics Research,
+#                : Department of Biomedical Informatics,
+#                : Vanderbilt University Medical Center
+# Email          : agent@local
+# Date           : 2026-10-18
+# Description    : Columnar, memory-mapped export of the structural tables.
+#                : Each structure label is written to its own directory
+#                : with one typed binary file per column and an index of
+#                : row ranges by (structid,biounit), so that residues,
+#                : coordinates, and alignments may be read as array views
+#                : without querying MySQL.
+#=============================================================================#
+
+# See main check for cmd line parsing
+import sys,os,json,shutil,tempfile
+import numpy as np
+
+class PDBMapColumnStore():
+  # Column names and types. Strings are fixed width; missing floats are
+  # NaN and missing integers are -1.
+  COLUMNS = [('biounit','i4'),('model','i4'),('chain','S10'),('seqid','i4'),
+             ('icode','S1'),('rescode','S1'),('x','f8'),('y','f8'),('z','f8'),
+             ('ss','S1'),('rsa','f8'),('phi','f8'),('psi','f8'),('tco','f8'),
+             ('kappa','f8'),('alpha','f8'),('unp','S50'),('hybrid','i1'),
+             ('enst','S50'),('aln_trans_seqid','i4'),('ensg','S50'),
+             ('perc_identity','f8')]
+
+  def __init__(self,store_dir,label):
+    """ Initialization requires the store directory and a structure label """
+    self.path    = os.path.join(store_dir,label)
+    self.label   = label
+    self._index  = None
+    self._arrays = None
+
+  def exists(self):
+    """ True if this label has been exported """
+    return os.path.exists(os.path.join(self.path,"meta.json"))
+
+  def export(self,io,buffer_size=100000):
+    """ Exports all residues of this label from the database, one row per
+        residue. A residue aligned to several transcripts keeps only its
+        alignment with the highest percent identity. The new store
+        replaces any previous export only once complete. """
+    parent = os.path.dirname(self.path)
+    if parent and not os.path.exists(parent):
+      os.makedirs(parent)
+    tdir  = tempfile.mkdtemp(dir=parent or None)
+    index = {}
+    nrows = 0
+    fouts = dict((name,open(os.path.join(tdir,"%s.bin"%name),'wb')) for name,dtype in self.COLUMNS)
+    try:
+      rows,key,start,last = [],None,0,None
+      res = io.secure_query(PDBMapColumnStore.export_query,(self.label,),cursorclass='SSCursor')
+      for row in res:
+        # Skip the other alignments of a residue (ordered by identity)
+        if row[:6] == last: continue
+        last = row[:6]
+        # Rows are ordered by structure and biological assembly
+        if (row[0],row[1]) != key:
+          if key: index["%s:%d"%key] = (start,nrows)
+          key,start = (row[0],row[1]),nrows
+        rows.append(row[1:])
+        nrows += 1
+        if len(rows) >= buffer_size:
+          self._write(fouts,rows)
+          rows = []
+      if key: index["%s:%d"%key] = (start,nrows)
+      self._write(fouts,rows)
+      for fout in fouts.values():
+        fout.close()
+      with open(os.path.join(tdir,"index.json"),'w') as fout:
+        json.dump(index,fout)
+      meta = {'label':self.label,'nrows':nrows,'columns':self.COLUMNS}
+      with open(os.path.join(tdir,"meta.json"),'w') as fout:
+        json.dump(meta,fout)
+      # Replace the previous export
+      if os.path.exists(self.path):
+        shutil.rmtree(self.path)
+      os.rename(tdir,self.path)
+    except:
+      for fout in fouts.values():
+        fout.close()
+      shutil.rmtree(tdir,ignore_errors=True)
+      raise
+    self._index,self._arrays = None,None
+    return nrows
+
+  def _write(self,fouts,rows):
+    """ Appends a buffer of rows to each column file """
+    if not rows: return
+    for i,(name,dtype) in enumerate(self.COLUMNS):
+      vals = [r[i] for r in rows]
+      if dtype[0] == 'S':
+        vals = ['' if v is None else v for v in vals]
+      elif dtype[0] == 'f':
+        vals = [np.nan if v is None else v for v in vals]
+      else:
+        vals = [-1 if v is None else v for v in vals]
+      np.array(vals,dtype=dtype).tofile(fouts[name])
+
+  def _open(self):
+    """ Memory-maps each column and loads the index """
+    if self._arrays is not None: return
+    if not self.exists():
+      msg = "ERROR (PDBMapColumnStore) No columnar export for %s in %s."%(self.label,self.path)
+      raise Exception(msg)
+    with open(os.path.join(self.path,"meta.json"),'r') as fin:
+      meta = json.load(fin)
+    with open(os.path.join(self.path,"index.json"),'r') as fin:
+      self._index = json.load(fin)
+    nrows = meta['nrows']
+    self._arrays = {}
+    for name,dtype in meta['columns']:
+      fname = os.path.join(self.path,"%s.bin"%name)
+      if nrows:
+        self._arrays[name] = np.memmap(fname,dtype=str(dtype),mode='r',shape=(nrows,))
+      else:
+        self._arrays[name] = np.zeros(0,dtype=str(dtype))
+
+  def __contains__(self,key):
+    """ True if (structid,biounit) is in the store """
+    self._open()
+    return "%s:%d"%key in self._index
+
+  def keys(self):
+    """ Returns all (structid,biounit) in the store """
+    self._open()
+    return [(k.rsplit(':',1)[0],int(k.rsplit(':',1)[1])) for k in self._index]
+
+  def load(self,structid,biounit=0):
+    """ Returns a dictionary of read-only array views, one per column, for
+        the residues of one structure or biological assembly """
+    self._open()
+    key = "%s:%d"%(structid,biounit)
+    if key not in self._index:
+      return None
+    start,stop = self._index[key]
+    return dict((name,arr[start:stop]) for name,arr in self._arrays.iteritems())
+
+  # All residues of a label with their chain and alignment information,
+  # ordered so that each (structid,biounit) is contiguous. A residue has
+  # one row per aligned transcript, the best aligned transcript first.
+  export_query = """SELECT a.structid,a.biounit,a.model,a.chain,a.seqid,a.icode,a.rescode,
+  a.x,a.y,a.z,a.ss,a.rsa,a.phi,a.psi,a.tco,a.kappa,a.alpha,b.unp,b.hybrid,
+  h.transcript,h.trans_seqid,i.gene,j.perc_identity
+  FROM Residue as a
+  LEFT JOIN Chain as b
+  ON a.label=b.label AND a.structid=b.structid AND a.biounit=b.biounit AND a.model=b.model AND a.chain=b.chain
+  LEFT JOIN Alignment as h USE INDEX(PRIMARY)
+  ON a.label=h.label AND a.structid=h.structid AND a.chain=h.chain AND a.seqid=h.chain_seqid
+  LEFT JOIN Transcript as i USE INDEX(PRIMARY)
+  ON h.label=i.label AND h.transcript=i.transcript AND h.trans_seqid=i.seqid
+  LEFT JOIN AlignmentScore as j
+  ON h.label=j.label AND h.structid=j.structid AND h.chain=j.chain AND h.transcript=j.transcript
+  WHERE a.label=%s
+  ORDER BY a.structid,a.biounit,a.model,a.chain,a.seqid,a.icode,
+  j.perc_identity DESC,h.transcript"""
+
+# Main check
+if __name__== "__main__":
+  sys.stderr.write("Class definition. Should not be called from command line.\n")
+  sys.exit(1)
@@ -13,7 +13,7 @@
 
 
 # See main check for cmd line parsing
-import sys,os,csv,collections,gzip,time,random
+import sys,os,csv,collections,gzip,time,random,threading,sqlite3,zlib
 import subprocess as sp
 from Bio.PDB.PDBParser import PDBParser
 from Bio.PDB.PDBIO import PDBIO
@@ -24,6 +24,7 @@ from PDBMapModel import PDBMapModel
 from PDBMapSwiss import PDBMapSwiss
 from PDBMapProtein import PDBMapProtein
 from PDBMapStructure import PDBMapStructure
+from PDBMapColumnStore import PDBMapColumnStore
 import MySQLdb, MySQLdb.cursors
 from warnings import filterwarnings,resetwarnings
 from Bio.PDB.PDBExceptions import PDBConstructionWarning
@@ -32,6 +33,34 @@ logging.basicConfig(format='%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d
     datefmt='%d-%m-%Y:%H:%M:%S',)
 
 class PDBMapIO(PDBIO):
+  # Pooled connections idle longer than this (seconds) are pinged before reuse.
+  POOL_IDLE_PING = 60
+  # Maximum number of open connections, idle or checked out, across all
+  # threads and cursor classes. Each thread checks out at most one
+  # connection per cursorclass (see _pooled) and returns them with release.
+  POOL_MAX = 8
+  # Existence check queries, keyed on (table,column,label)
+  _exists_stmts = {}
+  # Identifiers already loaded, keyed on (table,label). Populated by
+  # preload_loaded; labels without an entry are checked against MySQL.
+  _loaded = {}
+  # (table,label) keys that other processes may load concurrently; misses
+  # in their preloaded identifiers are confirmed against MySQL
+  _loaded_shared = set()
+  _id_columns = {'Structure':'pdbid','Model':'modelid','Swiss':'modelid'}
+  # Directory of columnar structure exports (see PDBMapColumnStore) and
+  # the open stores, keyed on structure label
+  column_store_dir = None
+  _column_stores = {}
+  # Optional SQLite cache of parsed DSSP results, keyed on file path and
+  # invalidated when the file's modification time or size changes
+  dssp_store_fname = None
+  _dssp_con = None
+  _dssp_pid = None
+  DSSP_DTYPE = [('chain','S1'),('seqid','i4'),('icode','S1'),('aa','S1'),('ss','S1'),
+                ('acc','f8'),('tco','f8'),('kappa','f8'),('alpha','f8'),
+                ('phi','f8'),('psi','f8'),('rsa','f8')]
+
   def __init__(self,dbhost=None,dbuser=None,dbpass=None,dbname=None,slabel="",dlabel="",createdb=False):
     super(PDBMapIO,self).__init__()
     self.dbhost = dbhost
@@ -40,7 +69,13 @@ class PDBMapIO(PDBIO):
     self.dbname = dbname
     self.slabel = slabel
     self.dlabel = dlabel
-    self._cons  = []   # Define the connection pool
+    self._pool  = {}   # Idle connections, keyed by cursorclass
+    self._pool_used = {} # Last use of each open connection
+    self._pool_lock = threading.Condition() # Guards the pool and its stats
+    self._local = threading.local() # Per-thread connections and cursors
+    self._sifts  = (None,{}) # SIFTS rows for the current PDB ID
+    self.pool_stats = {'hits':0,'creates':0,'pings':0,'pings_saved':0,
+                       'cursor_reuse':0,'evictions':0,'waits':0}
     self._con   = None # Define the connection
     self._c     = None # Define the cursor
     self.check_schema()
@@ -50,8 +85,17 @@ class PDBMapIO(PDBIO):
 
   def __del__(self):
     # Guarantee all database connections are closed
-    for con in self._cons:
-      con.close()
+    for con in self._pool_used.keys():
+      try:
+        con.close()
+      except:
+        pass
+
+  # The active connection and cursor belong to the calling thread
+  _con = property(lambda self: getattr(self._local,'con',None),
+                  lambda self,con: setattr(self._local,'con',con))
+  _c   = property(lambda self: getattr(self._local,'c',None),
+                  lambda self,c: setattr(self._local,'c',c))
 
 
   def is_nmr(self,pdbid,label=-1):
@@ -75,89 +119,103 @@ class PDBMapIO(PDBIO):
     # None is a valid argument to label
     if label == -1:
       label=self.slabel
-    self._connect()
-    query  = "SELECT * FROM Structure WHERE pdbid=%s "
-    if label:
-      query += "AND label=%s "
-    query += "LIMIT 1"
-    if label:
-      self._c.execute(query,(pdbid,label))
-    else:
-      self._c.execute(query,(pdbid,))
-    res = True if self._c.fetchone() else False
-    self._close()
-    return res
+    return self._in_db('Structure','pdbid',pdbid,label)
 
   def model_in_db(self,modelid,label=-1):
     # None is a valid argument to label
     if label == -1:
       label=self.slabel
-    self._connect()
-    query = "SELECT * FROM Model WHERE modelid=%s "
-    if label:
-      query += "AND label=%s "
-    query += "LIMIT 1"
-    if label:
-      self._c.execute(query,(modelid,label))
-    else:
-      self._c.execute(query,(modelid,))
-    res = True if self._c.fetchone() else False
-    self._close()
-    return res
+    return self._in_db('Model','modelid',modelid,label)
 
   def swiss_in_db(self,modelid,label=-1):
     # None is a valid argument to label
     if label == -1:
       label=self.slabel
-    self._connect()
-    query = "SELECT * FROM Swiss WHERE modelid=%s "
-    if label:
-      query += "AND label=%s "
-    query += "LIMIT 1"
-    if label:
-      self._c.execute(query,(modelid,label))
+    return self._in_db('Swiss','modelid',modelid,label)
+
+  def _in_db(self,table,column,value,label=None):
+    """ Cached existence check on a reusable cursor """
+    # Use the preloaded identifiers if available for this label
+    loaded = PDBMapIO._loaded.get((table,label),None)
+    if loaded is not None:
+      if value in loaded:
+        return True
+      if (table,label) not in PDBMapIO._loaded_shared:
+        return False
+    query = PDBMapIO._exists_stmt(table,"%s=%%s"%column,bool(label))
+    qvars = (value,label) if label else (value,)
+    return True if self._fetch_first(query,qvars) else False
+
+  def _fetch_first(self,query,qvars):
+    """ Returns the first row of a cached statement, executed on this
+        thread's reusable cursor """
+    con = self._pooled(MySQLdb.cursors.Cursor)
+    stmt_c = getattr(self._local,'stmt_c',None)
+    if stmt_c and stmt_c[0] is con:
+      c = stmt_c[1]
+      self.pool_stats['cursor_reuse'] += 1
     else:
-      self._c.execute(query,(modelid,))
-    res = True if self._c.fetchone() else False
-    self._close()
-    return res
+      c = con.cursor()
+      self._local.stmt_c = (con,c)
+    c.execute(query,qvars)
+    return c.fetchone()
+
+  def preload_loaded(self,table,label=-1,shared=False):
+    """ Fetches all identifiers already loaded into table under label so
+        that subsequent existence checks are local lookups. The snapshot
+        is per process: it is taken once, and then only records uploads
+        made by this process (and, for forked workers, by that worker).
+        Set shared if other workers, array tasks, or queue consumers may
+        load into the same table and label; identifiers missing from the
+        snapshot are then confirmed against MySQL. """
+    if label == -1:
+      label=self.slabel
+    query = "SELECT %s FROM %s WHERE label=%%s"%(PDBMapIO._id_columns[table],table)
+    loaded = set(r[0] for r in self.secure_query(query,(label,),cursorclass='SSCursor'))
+    PDBMapIO._loaded[(table,label)] = loaded
+    if shared:
+      PDBMapIO._loaded_shared.add((table,label))
+    else:
+      PDBMapIO._loaded_shared.discard((table,label))
+    return len(loaded)
+
+  @classmethod
+  def _mark_loaded(cls,table,value,label):
+    """ Records a committed upload in the preloaded identifiers """
+    if (table,label) in PDBMapIO._loaded:
+      PDBMapIO._loaded[(table,label)].add(value)
+
+  @classmethod
+  def _exists_stmt(cls,table,where,label,select="1"):
+    """ Returns the cached existence query for a table and condition """
+    key = (table,where,label,select)
+    if key not in cls._exists_stmts:
+      query  = "SELECT %s FROM %s WHERE %s "%(select,table,where)
+      if label:
+        query += "AND label=%s "
+      query += "LIMIT 1"
+      cls._exists_stmts[key] = query
+    return cls._exists_stmts[key]
 
   def unp_in_db(self,unpid,label=-1):
     # None is a valid argument to label
     if label == -1:
       label=self.slabel
-    self._connect()
-    query = "SELECT * FROM Chain WHERE (unp='%s' OR base_unp LIKE '%s-%%') "
-    if label:
-      query += "AND label=%s"
-    query += "LIMIT 1"
-
+    query = PDBMapIO._exists_stmt('Chain',"(unp=%s OR base_unp LIKE %s)",bool(label))
     base_unp = unpid.split('-')[0]
+    qvars = (base_unp,base_unp+'-%')
     if label:
-      self._c.execute(query,(base_unp,base_unp,label))
-    else:
-      self._c.execute(query,(base_unp,base_unp))
-    res = True if self._c.fetchone() else False
-    self._close()
-    return res
+      qvars += (label,)
+    return True if self._fetch_first(query,qvars) else False
 
   def gene_in_db(self,gene,label=-1):
     # None is a valid argument to label
     if label == -1:
       label=self.slabel
-    self._connect()
-    query  = "SELECT unp FROM Chain a WHERE gene=%s "
-    if label:
-      query += "AND label=%s"
-    query += "LIMIT 1"
-    if label:
-      self._c.execute(query,(gene,label))
-    else:
-      self._c.execute(query,(gene,))
-    res = self._c.fetchone()
-    self._close()
+    query = PDBMapIO._exists_stmt('Chain',"gene=%s",bool(label),select="unp")
+    res = self._fetch_first(query,(gene,label) if label else (gene,))
     if res:
-      return True,res['unp'][0]
+      return True,res[0]
     return False,None
 
   def genomic_datum_in_db(self,name,label=None):
@@ -182,86 +240,40 @@ class PDBMapIO(PDBIO):
       msg += "already in database.\n"
       sys.stderr.write(msg)
       return(1)
-    # Upload entire structure (structure, chains, residues)
-    queries = []
+    # Collect typed row tuples for each table. Rows are sent with
+    # executemany, which batches them into multi-row INSERTs.
     s = self.structure
+    srows,crows,rrows = [],[],[]
+    trows,arows,asrows = [],[],[]
 
     # Upload the structure if skip not specified
     if not model:
       h = s.header
-      squery  = 'INSERT IGNORE INTO Structure '
-      squery += '(label,pdbid,method,quality,resolution,`name`,author,deposition,`release`,compound,keywords,reference,structure_reference) '
-      squery += 'VALUES ('
-      squery += '"%(label)s","%(id)s","%(structure_method)s",%(quality)f,'
-      squery += '%(resolution)f,"%(name)s","%(author)s","%(deposition_date)s",'
-      squery += '"%(release_date)s","%(compound)s","%(keywords)s",'
-      squery += '"%(journal)s","%(structure_reference)s")'
-      sfields = dict((key,s.__getattribute__(key)) for key in dir(s) 
-                    if isinstance(key,collections.Hashable))
-      # Add the header fields
-      sfields.update(s.header)
-      # Add the internal structure fields
-      sfields.update(dict((key,s.structure.__getattribute__(key)) for key in 
-                      dir(s.structure) if isinstance(key,collections.Hashable)))
-      sfields["label"] = self.slabel
-      squery = squery%sfields
-      queries.append(squery)
+      srows.append((self.slabel,s.id,h['structure_method'],float(s.quality),
+                    float(h['resolution']),h['name'],h['author'],
+                    h['deposition_date'],h['release_date'],h['compound'],
+                    h['keywords'],h['journal'],h['structure_reference']))
 
     # Upload the models, chains,and residues
     for m in s:
-      mfields = dict((key,m.__getattribute__(key)) for key in dir(m) 
-                      if isinstance(key,collections.Hashable))
-      if mfields['biounit'] > 0: # remove biounit tag
-        mfields['id'] = int(mfields['id'].split('.')[-1])
-        mfields['id'] += 1 # correct indexing
+      # Remove the biounit tag from biological assembly model IDs
+      if m.biounit > 0:
+        mid = int(m.id.split('.')[-1]) + 1 # correct indexing
+      else:
+        mid = m.id
       for c in m:
-        cquery  = "INSERT IGNORE INTO Chain "
-        cquery += "(label,structid,biounit,model,chain,unp,gene,offset,hybrid,sequence) "
-        cquery += "VALUES "
-        cquery += '("%(label)s","%(id)s",'%sfields # structure id
-        cquery += '%(biounit)d,%(id)d,'%mfields # model id
-        cquery += '"%(id)s","%(unp)s","%(gene)s",%(offset)d,%(hybrid)d,"%(sequence)s")'
-        cfields = dict((key,c.__getattribute__(key)) for key in dir(c) 
-                        if isinstance(key,collections.Hashable))
-        cfields["label"] = self.slabel
-        cquery = cquery%cfields
-        queries.append(cquery)
-        rquery  = "INSERT IGNORE INTO Residue "
-        rquery += "(label,structid,biounit,model,chain,resname,rescode,seqid,icode,x,y,z,ss,rsa,phi,psi,tco,kappa,alpha,conflict) "
-        rquery += "VALUES "
+        crows.append((self.slabel,s.id,m.biounit,mid,c.id,c.unp,c.gene,
+                      c.offset,c.hybrid,c.sequence))
         for r in c:
-          # If length exceeds 10 thousand characters, start a new query
-          if len(rquery) > 10000:
-            queries.append(rquery[:-1])
-            rquery  = "INSERT IGNORE INTO Residue "
-            rquery += "(label,structid,biounit,model,chain,resname,rescode,seqid,icode,x,y,z,ss,rsa,phi,psi,tco,kappa,alpha,conflict) "
-            rquery += "VALUES "
-          # Continue with the next query
-          rquery += '("%(label)s","%(id)s",'%sfields # structure id
-          rquery += '%(biounit)d,%(id)d,'%mfields # model id
-          rquery += '"%(id)s",'%cfields  # chain id
-          rquery += '"%(resname)s","%(rescode)s",%(seqid)d,'
-          rquery += '"%(icode)s",%(x)f,%(y)f,%(z)f,'
-          rquery += '"%(ss)s",%(rsa)s,%(phi)s,%(psi)s,'
-          rquery += '%(tco)s,%(k)s,%(a)s,%(conflict)s),'
-          rfields = dict((key,r.__getattribute__(key)) for key in dir(r) 
-                          if isinstance(key,collections.Hashable))
-          rfields["conflict"] = '"%s"'%rfields["conflict"] if rfields["conflict"] else '\N'
-          for key,val in rfields.iteritems():
-            if val is None:
-              if key == 'ss':
-                rfields[key] = '?'
-              else:
-                rfields[key] = 'NULL'
-          rfields["label"] = self.slabel
-          rquery = rquery%rfields
-        queries.append(rquery[:-1])
+          ss = r.ss if r.ss is not None else '?'
+          conflict = r.conflict if r.conflict else None
+          rrows.append((self.slabel,s.id,m.biounit,mid,c.id,r.resname,
+                        r.rescode,r.seqid,r.icode,float(r.x),float(r.y),
+                        float(r.z),ss,r.rsa,r.phi,r.psi,r.tco,r.k,r.a,
+                        conflict))
 
     # Upload the transcripts
     try:
-      tquery  = "INSERT IGNORE INTO Transcript "
-      tquery += "(label,transcript,protein,gene,seqid,rescode,chr,start,end,strand) "
-      tquery += "VALUES "
       # Inner exception if empty list, outer exception if error during query
       if not len(s.get_transcripts(io=self)):
         msg = "No transcripts for structure %s, proteins: %s"%(s.id,','.join([c.unp for m in s for c in m]))
@@ -269,54 +281,40 @@ class PDBMapIO(PDBIO):
         raise Exception(msg)
       seen = set([])
       for t in s.get_transcripts(io=self):
-        if t.transcript not in seen or seen.add(t.transcript):
-          for seqid,(rescode,chr,start,end,strand) in t.sequence.iteritems():
-            # If length exceeds 10 thousand characters, start a new query
-            if len(tquery) > 10000:
-              queries.append(tquery[:-1])
-              tquery  = "INSERT IGNORE INTO Transcript "
-              tquery += "(label,transcript,protein,gene,seqid,rescode,chr,start,end,strand) "
-              tquery += "VALUES "
-            tquery += '("%s","%s","%s","%s",'%(self.slabel,t.transcript,t.protein,t.gene)
-            tquery += '%d,"%s",'%(seqid,rescode)
-            tquery += '"%s",%d,%d,%d),'%(chr,start,end,strand)
-      queries.append(tquery[:-1])
+        if t.transcript in seen: continue
+        seen.add(t.transcript)
+        for seqid,(rescode,chr,start,end,strand) in t.sequence.iteritems():
+          trows.append((self.slabel,t.transcript,t.protein,t.gene,
+                        seqid,rescode,chr,start,end,strand))
     except Exception as e:
       msg = "ERROR (PDBMapIO) Failed to get transcripts for %s: %s"%(s.id,str(e).rstrip('\n'))
       raise Exception(msg)
 
-    # Upload the alignments
-    aquery  = "INSERT IGNORE INTO Alignment "
-    aquery += "(label,structid,chain,chain_seqid,transcript,trans_seqid) "
-    aquery += "VALUES "
+    # Upload the alignments and alignment scores
     for a in s.get_alignments():
       for c_seqid,t_seqid in a.pdb2seq.iteritems():
-        # If length exceeds 10 thousand characters, start a new query
-        if len(aquery) > 10000:
-          queries.append(aquery[:-1])
-          aquery  = "INSERT IGNORE INTO Alignment "
-          aquery += "(label,structid,chain,chain_seqid,transcript,trans_seqid) "
-          aquery += "VALUES "
-        aquery += '("%s","%s","%s",%d,'%(self.slabel,s.id,a.chain.id,c_seqid)
-        aquery += '"%s",%d),'%(a.transcript.transcript,t_seqid)
-    queries.append(aquery[:-1])
-
-    # Upload the alignment scores
-    asquery = "INSERT IGNORE INTO AlignmentScore "
-    asquery += "(label,structid,chain,transcript,score,perc_aligned,perc_identity,alignment) "
-    asquery += "VALUES "
-    for a in s.get_alignments():
-      asquery += '("%s","%s","%s","%s",%f,%f,%f,"%s"),'% \
-                  (self.slabel,s.id,a.chain.id,a.transcript.transcript,
-                   a.score,a.perc_aligned,a.perc_identity,a.aln_str)
-    queries.append(asquery[:-1])
+        arows.append((self.slabel,s.id,a.chain.id,c_seqid,
+                      a.transcript.transcript,t_seqid))
+      asrows.append((self.slabel,s.id,a.chain.id,a.transcript.transcript,
+                     float(a.score),float(a.perc_aligned),
+                     float(a.perc_identity),a.aln_str))
 
-    # Execute all queries at once to ensure everything completed.
+    # Execute all inserts in one transaction to ensure everything completed.
+    # The Structure row is written last, as before.
+    inserts = [(PDBMapIO.structure_insert,srows),
+               (PDBMapIO.chain_insert,crows),
+               (PDBMapIO.residue_insert,rrows),
+               (PDBMapIO.transcript_insert,trows),
+               (PDBMapIO.alignment_insert,arows),
+               (PDBMapIO.alignment_score_insert,asrows)]
     try:
       self._connect()
-      for q in queries[::-1]:
-        self._c.execute(q)
+      for query,rows in inserts[::-1]:
+        if rows:
+          self._c.executemany(query,rows)
       self._con.commit()
+      if not model:
+        PDBMapIO._mark_loaded('Structure',s.id,self.slabel)
     except:
       msg  = "ERROR (PDBMapIO) Query failed for %s: "%s.id
       msg += "%s\n"%self._c._last_executed
@@ -353,6 +351,7 @@ class PDBMapIO(PDBIO):
     self._connect()
     self._c.execute(mquery)
     self._close()
+    PDBMapIO._mark_loaded('Model',m.id,self.slabel)
 
   def upload_swiss(self):
     """ Uploades the current swissmodel in PDBMapIO """
@@ -381,121 +380,227 @@ class PDBMapIO(PDBIO):
     self._connect()
     self._c.execute(mquery)
     self._close()
+    PDBMapIO._mark_loaded('Swiss',m.id,self.slabel)
 
 
   # Prepare the Model summary information (if no errors occurred)
-  def upload_genomic_data(self,dstream,dname):
+  def upload_genomic_data(self,dstream,dname,buffer_size=1):
     """ Uploads genomic data via a PDBMapData generator """
     filterwarnings('ignore', category = MySQLdb.Warning)
+    # Variants are inserted and committed buffer_size records at a time
+    buffer_size = max(1,int(buffer_size))
+    batch = []
+    t0 = time.time()
     i=0 # ensure initialization
     for i,record in enumerate(dstream):
       if not i%1000:
-        sys.stdout.write("\rRecords uploaded: %5d"%i)
-      # Upload all non-consequence information to GenomicData
+        rate = i / max(time.time()-t0,1e-6)
+        sys.stdout.write("\rRecords uploaded: %5d (%.0f records/s)"%(i,rate))
+        sys.stdout.flush()
+      # Label the variant and each of its consequences
       record.INFO['LABEL'] = dname
-      query  = "INSERT IGNORE INTO GenomicData "
-      query += "(label,chr,start,end,name,variation,vtype,svtype,ref_allele,alt_allele,"
-      query += "svlen,quality,avgpost,rsq,erate,theta,ldaf,ac,an,aa,da,maf,amr_af,asn_af,"
-      query += "eas_af,sas_af,afr_af,eur_af,ens_gene,hgnc_gene,"
-      query += "snpsource,format,gt) VALUES "
-      query += "(%(LABEL)s,%(CHROM)s,%(START)s,%(END)s,%(ID)s,%(EXISTING)s,%(VT)s,"
-      query += "%(SVTYPE)s,%(REF)s,%(ALT)s,%(SVLEN)s,%(QUAL)s,%(AVGPOST)s,%(RSQ)s,"
-      query += "%(ERATE)s,%(THETA)s,%(LDAF)s,%(AC)s,%(AN)s,%(AA)s,%(DA)s,"
-      query += "%(AF)s,%(AMR_AF)s,%(ASN_AF)s,%(EAS_AF)s,%(SAS_AF)s,%(AFR_AF)s,%(EUR_AF)s,"
-      query += "%(GENE)s,%(HGNC)s,%(SNPSOURCE)s,%(FORMAT)s,%(GT)s)"
-      try:
+      for csq in record.CSQ:
+        csq["LABEL"] = self.dlabel
+      batch.append(record)
+      if len(batch) >= buffer_size:
+        self._upload_genomic_batch(batch)
+        batch = []
+    # Upload any records left in the buffer
+    if batch:
+      self._upload_genomic_batch(batch)
+    elapsed = time.time()-t0
+    sys.stdout.write("\rRecords uploaded: %5d in %.1fs (%.0f records/s)\n"%(
+                      i,elapsed,i/max(elapsed,1e-6)))
+    resetwarnings()
+    return i # return the number of uploaded rows
+
+  def _upload_genomic_batch(self,records):
+    """ Uploads a batch of variants and their consequences in a single
+        transaction. A failed batch is bisected to isolate bad records. """
+    if len(records) == 1:
+      return self._upload_genomic_record(records[0])
+    try:
+      self._connect(cursorclass=MySQLdb.cursors.Cursor)
+      self._c.executemany(PDBMapIO.genomic_data_insert,
+                          [record.INFO for record in records])
+      csqs = [csq for record in records for csq in record.CSQ]
+      if csqs:
+        self._c.executemany(PDBMapIO.genomic_consequence_insert,csqs)
+      self._con.commit()
+      failed = False
+    except Exception as e:
+      self._con.rollback()
+      failed = True
+    finally:
+      self._close()
+    if failed:
+      # Retry each half independently
+      mid = len(records) / 2
+      self._upload_genomic_batch(records[:mid])
+      self._upload_genomic_batch(records[mid:])
+
+  def _upload_genomic_record(self,record):
+    """ Uploads a single variant and each of its consequences """
+    try:
+      self._connect(cursorclass=MySQLdb.cursors.Cursor)
+      self._c.execute(PDBMapIO.genomic_data_insert,record.INFO)
+      self._con.commit()
+    except Exception as e:
+      if "_last_executed" in dir(self._c):
+        msg = self._c._last_executed.replace('\n',';')
+        sys.stderr.write("WARNING (PDBMapIO) GenomicData query failed, query: %s\n"%msg)
+      else:
+        msg  = str(e).replace('\n',';')
+        msg += "WARNING (PDBMapIO) GenomicData query failed, exception: %s\n"%msg
+        sys.stderr.write(msg)
+      self._con.rollback()
+      return # halt upload of this variant
+    finally:
+      self._close()
+    # Upload each consequence to GenomicConsequence
+    for csq in record.CSQ:
+      try: 
         self._connect(cursorclass=MySQLdb.cursors.Cursor)
-        self._c.execute(query,record.INFO)
+        self._c.execute(PDBMapIO.genomic_consequence_insert,csq)
         self._con.commit()
       except Exception as e:
         if "_last_executed" in dir(self._c):
           msg = self._c._last_executed.replace('\n',';')
-          sys.stderr.write("WARNING (PDBMapIO) GenomicData query failed, query: %s\n"%msg)
+          sys.stderr.write("WARNING (PDBMapIO) GenomicConsequence query failed, query:: %s\n"%msg)
         else:
           msg  = str(e).replace('\n',';')
-          msg += "WARNING (PDBMapIO) GenomicData query failed, exception: %s\n"%msg
-          sys.stderr.write(msg)
+          msg += "WARNING (PDBMapIO) GenomicConsequence query failed, exception: %s\n"%msg
+          sys.stderr.write(msg)    
         self._con.rollback()
-        continue # halt upload of this variant
+        continue # skip this consequence
       finally:
         self._close()
 
-      # Upload each consequence to GenomicConsequence
-      query  = "INSERT IGNORE INTO GenomicConsequence "
-      query += "(label,chr,start,end,name,transcript,protein,uniprot,canonical,allele,"
-      query += "consequence,cdna_pos,cds_pos,protein_pos,ref_amino_acid,"
-      query += "alt_amino_acid,ref_codon,alt_codon,polyphen,sift,biotype,"
-      query += "domains) VALUES "
-      query += "(%(LABEL)s,%(CHROM)s,%(START)s,%(END)s,%(ID)s,"
-      query += "%(Feature)s,%(ENSP)s,%(SWISSPROT)s,%(CANONICAL)s,%(Allele)s,"
-      query += "%(Consequence)s,%(cDNA_position)s,%(CDS_position)s,"
-      query += "%(Protein_position)s,%(Ref_AminoAcid)s,%(Alt_AminoAcid)s,"
-      query += "%(Ref_Codon)s,%(Alt_Codon)s,%(PolyPhen)s,%(SIFT)s,"
-      query += "%(BIOTYPE)s,%(DOMAINS)s)"
-      for csq in record.CSQ:
-        csq["LABEL"] = self.dlabel
-        try: 
-          self._connect(cursorclass=MySQLdb.cursors.Cursor)
-          self._c.execute(query,csq)
-          self._con.commit()
-        except Exception as e:
-          if "_last_executed" in dir(self._c):
-            msg = self._c._last_executed.replace('\n',';')
-            sys.stderr.write("WARNING (PDBMapIO) GenomicConsequence query failed, query:: %s\n"%msg)
-          else:
-            msg  = str(e).replace('\n',';')
-            msg += "WARNING (PDBMapIO) GenomicConsequence query failed, exception: %s\n"%msg
-            sys.stderr.write(msg)    
-          self._con.rollback()
-          continue # halt upload of this variant
-        finally:
-          self._close()
-    resetwarnings()
-    return i # return the number of uploaded rows
+  def upload_intersection(self,dstream,buffer_size=5000,load_infile=False):
+    """ Uploads an intersection via a process parser generator. Rows are
+        streamed in multi-row batches, or through a pipe to LOAD DATA. """
+    if load_infile:
+      return self._load_intersection(dstream)
+    nrows,rows = 0,[]
+    # Keep local references; the stream may query with other connections
+    c   = self._connect()
+    con = self._con
+    try:
+      for row in dstream:
+        rows.append(row)
+        if len(rows) >= buffer_size:
+          # MySQLdb sends each batch as one multi-row INSERT
+          c.executemany(PDBMapIO.intersection_insert,rows)
+          con.commit()
+          nrows += len(rows)
+          rows = []
+      # Upload any rows left in the buffer
+      if rows:
+        c.executemany(PDBMapIO.intersection_insert,rows)
+        con.commit()
+        nrows += len(rows)
+    except:
+      con.rollback()
+      raise
+    finally:
+      c.close()
+    return(nrows) # Return the number of uploaded rows
 
-  def upload_intersection(self,dstream,buffer_size=1):
-    """ Uploads an intersection via a process parser generator """
-    # Query header
-    queryh  = "INSERT IGNORE INTO GenomicIntersection "
-    queryh += "(dlabel,slabel,structid,chain,seqid,gc_id) VALUES "
-    # Query value string
-    queryv  = "(%s,%s,%s,%s,%s,%s)" # Direct reference
-    # Query value list
-    vals = []
-    # Query argument list
-    args = []
-    i=0 # ensure initialization
-    for i,row in enumerate(dstream):
-      row = list(row) # convert from tuple
-      vals.append(queryv)
-      args.extend(row)
-      if not (i+1) % buffer_size:
-        # Construct query string
-        query = queryh + ','.join(vals)
-        try:
-          self._connect()
-          self._c.execute(query,args)
-          self._con.commit()
-          vals,args = [],[]
-        except:
-          self._con.rollback()
-          raise
-        finally:
-          self._close()
-    # Upload any rows left in the buffer
-    if args:
-      # Construct query string
-      query = queryh + ','.join(vals)
+  def _load_intersection(self,dstream):
+    """ Streams intersection rows to LOAD DATA LOCAL INFILE through a
+        named pipe, avoiding statement parsing for very large uploads """
+    tdir = tempfile.mkdtemp()
+    fifo = os.path.join(tdir,"intersection.fifo")
+    os.mkfifo(fifo)
+    count = [0]
+    # Take the loading connection before the writer starts; from then on
+    # only the writer (through dstream) uses this PDBMapIO
+    c   = self._connect()
+    con = self._con
+    def writer():
       try:
-        self._connect()
-        self._c.execute(query,args)
-        self._con.commit()
-      except:
-        self._con.rollback()
-        raise
+        with open(fifo,'wb') as fout:
+          for row in dstream:
+            # LOAD DATA reads \N as NULL
+            fout.write("%s\n"%'\t'.join('\\N' if v is None else str(v) for v in row))
+            count[0] += 1
+      except IOError:
+        pass # reader closed the pipe after a failure
       finally:
-        self._close()
-    return(i) # Return the number of uploaded rows
+        # Finish any open query before returning the writer's connections
+        if hasattr(dstream,'close'):
+          dstream.close()
+        self.release()
+    t = threading.Thread(target=writer)
+    t.daemon = True
+    t.start()
+    try:
+      c.execute(PDBMapIO.intersection_load,(fifo,))
+      con.commit()
+    except:
+      con.rollback()
+      # Unblock the writer if LOAD DATA never opened the pipe
+      try: os.close(os.open(fifo,os.O_RDONLY|os.O_NONBLOCK))
+      except OSError: pass
+      raise
+    finally:
+      c.close()
+      t.join(60)
+      os.remove(fifo)
+      os.rmdir(tdir)
+    return(count[0])
+
+  def intersection_keys(self,enable=True):
+    """ Drops (enable=False) or recreates (enable=True) the secondary
+        indexes of GenomicIntersection, so that large loads only maintain
+        the primary key. InnoDB ignores ALTER TABLE ... DISABLE KEYS. The
+        gi_id index is kept because AUTO_INCREMENT requires it. """
+    query = "SHOW INDEX FROM GenomicIntersection"
+    names = set(r['Key_name'] for r in self.secure_query(query))
+    if enable:
+      alter = ["ADD KEY %s(%s)"%(n,cols) for n,cols in PDBMapIO.intersection_secondary_keys
+                if n not in names]
+    else:
+      alter = ["DROP KEY %s"%n for n,cols in PDBMapIO.intersection_secondary_keys
+                if n in names]
+    if not alter:
+      return 0
+    # One statement, so the table is rebuilt only once
+    return self.secure_command("ALTER TABLE GenomicIntersection %s"%','.join(alter))
+
+  def column_store(self,label=None):
+    """ Returns the columnar store for a structure label, or None if
+        the label has not been exported """
+    label = label if label else self.slabel
+    if not PDBMapIO.column_store_dir:
+      return None
+    if label not in PDBMapIO._column_stores:
+      store = PDBMapColumnStore(PDBMapIO.column_store_dir,label)
+      if not store.exists():
+        return None
+      PDBMapIO._column_stores[label] = store
+    return PDBMapIO._column_stores[label]
+
+  def export_columns(self,label=None):
+    """ Exports a structure label to the columnar store """
+    label = label if label else self.slabel
+    if not PDBMapIO.column_store_dir:
+      msg = "ERROR (PDBMapIO) No column_store directory specified."
+      raise Exception(msg)
+    store = PDBMapColumnStore(PDBMapIO.column_store_dir,label)
+    nrows = store.export(self)
+    PDBMapIO._column_stores[label] = store
+    return nrows
+
+  def load_columns(self,structid,biounit=0):
+    """ Returns array views of the residues and alignments of a structure
+        from the columnar export of this structure label, as a dictionary
+        keyed on column name. None if the label or structure was not exported. """
+    biounit = 0 if biounit < 0 else biounit
+    store = self.column_store()
+    if not store:
+      return None
+    return store.load(structid,biounit)
 
   def load_structure(self,structid,biounit=0,useranno=False,raw=False,syn=False):
     """ Reconstructs annotated PDBMapStructure from the database """
@@ -606,57 +711,145 @@ class PDBMapIO(PDBIO):
     return res
 
   @classmethod
-  def dssp(cls,m,fname,dssp_executable='dssp'):
-    # Create temp file containing only ATOM rows
+  def dssp(cls,m,fname,dssp_executable='dssp',lines=None):
+    """ Returns DSSP secondary structure and solvent accessibility for each
+        residue, keyed on (chain,seqid,icode). Results are read from the
+        DSSP store when the file is unchanged since it was last processed. """
+    key = PDBMapIO._dssp_key(fname)
+    resdict = PDBMapIO.dssp_cache_get(key)
+    if resdict is not None:
+      return resdict
+    resdict = PDBMapIO._run_dssp(fname,dssp_executable,lines)
+    if resdict:
+      PDBMapIO.dssp_cache_put(key,resdict)
+    return resdict
+
+  @classmethod
+  def use_dssp_store(cls,fname):
+    """ Enables the persistent DSSP store """
+    store_dir = os.path.dirname(fname)
+    if store_dir and not os.path.exists(store_dir):
+      os.makedirs(store_dir)
+    PDBMapIO.dssp_store_fname = fname
+    PDBMapIO._dssp_con = None
+
+  @classmethod
+  def _dssp_store(cls):
+    """ Returns this process's connection to the DSSP store """
+    if not PDBMapIO.dssp_store_fname:
+      return None
+    if PDBMapIO._dssp_pid != os.getpid() or not PDBMapIO._dssp_con:
+      # SQLite connections must not be shared across forked workers
+      con = sqlite3.connect(PDBMapIO.dssp_store_fname,timeout=300)
+      con.text_factory = str
+      con.execute("""CREATE TABLE IF NOT EXISTS DSSP (
+                     fname TEXT PRIMARY KEY,
+                     mtime REAL,
+                     size INTEGER,
+                     result BLOB NOT NULL)""")
+      con.commit()
+      PDBMapIO._dssp_con = con
+      PDBMapIO._dssp_pid = os.getpid()
+    return PDBMapIO._dssp_con
+
+  @classmethod
+  def _dssp_key(cls,fname):
+    """ Returns the (path,mtime,size) identifying this version of a file """
+    st = os.stat(fname)
+    return (os.path.abspath(fname),st.st_mtime,st.st_size)
+
+  @classmethod
+  def dssp_cache_get(cls,key):
+    """ Returns the stored DSSP results for this file version, or None """
+    con = PDBMapIO._dssp_store()
+    if not con:
+      return None
+    row = con.execute("SELECT result FROM DSSP WHERE fname=? AND mtime=? AND size=?",key).fetchone()
+    if not row:
+      return None
+    arr = np.frombuffer(zlib.decompress(str(row[0])),dtype=PDBMapIO.DSSP_DTYPE)
+    names = [f for f,dtype in PDBMapIO.DSSP_DTYPE]
+    resdict = {}
+    for vals in arr.tolist():
+      resinfo = dict(zip(names,vals))
+      resdict[(resinfo['chain'],resinfo['seqid'],resinfo['icode'])] = resinfo
+    return resdict
+
+  @classmethod
+  def dssp_cache_put(cls,key,resdict):
+    """ Stores DSSP results as a compressed record array """
+    con = PDBMapIO._dssp_store()
+    if not con:
+      return
+    names = [f for f,dtype in PDBMapIO.DSSP_DTYPE]
+    arr = np.array([tuple(r[f] for f in names) for r in resdict.values()],dtype=PDBMapIO.DSSP_DTYPE)
+    blob = sqlite3.Binary(zlib.compress(arr.tostring()))
+    con.execute("INSERT OR REPLACE INTO DSSP VALUES (?,?,?,?)",key+(blob,))
+    con.commit()
+
+  @classmethod
+  def _run_dssp(cls,fname,dssp_executable='dssp',lines=None):
+    """ Runs DSSP on the ATOM records of a PDB file. The records are read
+        in-process (or taken from lines, if already read) and piped to DSSP. """
     try:
-      temp_fileobject = tempfile.NamedTemporaryFile(delete=False)
-      tmpf = temp_fileobject.name
+      if lines is None:
+        if fname.split('.')[-1] == 'gz':
+          lines = gzip.open(fname,'rb').readlines()
+        else:
+          lines = open(fname,'rb').readlines()
+      atoms = ''.join(l for l in lines if l.startswith('ATOM'))
     except Exception as e:
-      raise Exception("Unable to create temporary file for dssp processing:\n%s"%str(e));
-    temp_fileobject.close();
-
-    cmd  = "grep ^ATOM %s > %s"%(fname,tmpf)
+      raise Exception("Unable to read ATOM records for dssp processing from %s:\n%s"%(fname,str(e)))
+    cmd = [dssp_executable,'/dev/stdin']
     try:
-      if fname.split('.')[-1] == 'gz':
-        cmd = 'z'+cmd
-      os.system(cmd)
-      cmd  = [dssp_executable,tmpf]
       # A problem with this code is that stderr coming from dssp messes up log badly
-      p = sp.Popen(cmd,stdout=sp.PIPE)
-      resdict = {}
-      start_flag = False
-      for i,line in enumerate(iter(p.stdout.readline,'')):
-        if not line: continue
-        if not start_flag:
-          if line.startswith('  #'):
-            start_flag = True
-          continue
-        resinfo = {}
-        if not line[5:10].strip(): continue
-        resinfo['seqid'] = int(line[5:10])
-        resinfo['icode'] = line[10:11]
-        resinfo['chain'] = line[11:12].upper()
-        if not resinfo['chain'].strip():
-          resinfo['chain'] = 'A'
-        resinfo['aa']    = line[13:14].upper()
-        resinfo['ss']    = line[16:17].upper()
-        resinfo['acc']   = float(line[34:38])
-        resinfo['tco']   = float(line[85:91])
-        resinfo['kappa'] = float(line[92:97])
-        resinfo['alpha'] = float(line[98:103])
-        resinfo['phi']   = float(line[103:109])
-        resinfo['psi']   = float(line[109:115])
-        resinfo['rsa']   = resinfo['acc'] / solv_acc[resinfo['aa']]
-        resdict[(resinfo['chain'],resinfo['seqid'],resinfo['icode'])] = resinfo.copy()
+      p = sp.Popen(cmd,stdin=sp.PIPE,stdout=sp.PIPE)
+      out,_ = p.communicate(atoms)
+      return PDBMapIO._parse_dssp(out)
     except Exception as e:
       msg = "ERROR (PDBMapIO) Unable to parse output from DSSP invocation: %s\nException:%s"%(str(cmd),str(e))
       raise Exception(msg)
-    finally:        
-      # Remove the temp ATOM file
-      try:
-        os.remove(tmpf)
-      except Exception as e:
-        raise Exception("Unable to delete dssp temporary input file %s\n:Exception:",str(tmpf),str(e))
+
+  @classmethod
+  def _parse_dssp(cls,out):
+    """ Parses the fixed-column residue records of DSSP output """
+    out = out.split('\n')
+    for i,line in enumerate(out):
+      if line.startswith('  #'):
+        break
+    else:
+      return {}
+    # Skip chain breaks, which have no residue number
+    rows = [l for l in out[i+1:] if l[5:10].strip()]
+    if not rows:
+      return {}
+    width = max(115,max(len(l) for l in rows))
+    buf = np.array([l.ljust(width) for l in rows],dtype='S%d'%width)
+    buf = buf.view('S1').reshape(len(rows),width)
+    def col(a,b):
+      return buf[:,a:b].copy().view('S%d'%(b-a)).ravel()
+    seqid = col(5,10).astype(int)
+    icode = col(10,11)
+    chain = np.char.upper(col(11,12))
+    chain[np.char.strip(chain)==''] = 'A'
+    aa    = np.char.upper(col(13,14))
+    ss    = np.char.upper(col(16,17))
+    acc   = col(34,38).astype(float)
+    tco   = col(85,91).astype(float)
+    kappa = col(92,97).astype(float)
+    alpha = col(98,103).astype(float)
+    phi   = col(103,109).astype(float)
+    psi   = col(109,115).astype(float)
+    rsa   = acc / np.array([solv_acc[a] for a in aa.tolist()])
+    # numpy strips trailing spaces from fixed-width strings
+    icode = [c if c else ' ' for c in icode.tolist()]
+    ss    = [c if c else ' ' for c in ss.tolist()]
+    resdict = {}
+    for vals in zip(seqid.tolist(),icode,chain.tolist(),aa.tolist(),ss,acc.tolist(),
+                    tco.tolist(),kappa.tolist(),alpha.tolist(),phi.tolist(),psi.tolist(),rsa.tolist()):
+      resinfo = dict(zip(('seqid','icode','chain','aa','ss','acc','tco','kappa',
+                          'alpha','phi','psi','rsa'),vals))
+      resdict[(resinfo['chain'],resinfo['seqid'],resinfo['icode'])] = resinfo
     return resdict
 
   def detect_entity_type(self,entity):
@@ -727,6 +920,42 @@ class PDBMapIO(PDBIO):
     #     rc += self.secure_command(q)
     # return rc
 
+  def get_sifts(self,pdbid):
+    """ Returns all SIFTS residue mappings for a PDB ID, grouped by
+        (chain,uniprot_acc). Fetched once per structure and reused by
+        the parser and by each chain-transcript alignment. """
+    # PDB IDs are case-insensitive, as in the MySQL comparison
+    if self._sifts[0] != pdbid.lower():
+      sifts = {}
+      res = self.secure_query(self.sifts_query,(pdbid,),cursorclass='Cursor')
+      for chain,acc,resnum,unp_resnum in res:
+        sifts.setdefault((chain,acc),[]).append((resnum,unp_resnum))
+      self._sifts = (pdbid.lower(),sifts)
+    return self._sifts[1]
+
+  def sifts_alignment(self,pdbid,chain,unp):
+    """ Returns (resnum,uniprot_resnum,uniprot_acc) SIFTS rows for one
+        chain and UniProt AC, ordered by resnum """
+    # Match chain and AC case-insensitively, as MySQL compared them
+    key  = (chain.upper(),unp.upper())
+    rows = sorted((resnum,unp_resnum,acc) for (c,acc),rows in self.get_sifts(pdbid).iteritems()
+                  if (c.upper(),acc.upper()) == key for resnum,unp_resnum in rows)
+    return rows
+
+  def sifts_ranges(self,pdbid):
+    """ Returns the SIFTS residue ranges of each chain and UniProt AC as
+        [chain,uniprot_acc,min(resnum),max(resnum),min(unp),max(unp)] """
+    ranges = []
+    for (chain,acc),rows in sorted(self.get_sifts(pdbid).iteritems()):
+      if not acc: continue
+      resnums = [r for r,u in rows if r is not None]
+      unpnums = [u for r,u in rows if u is not None]
+      ranges.append([chain,acc,min(resnums) if resnums else None,
+                      max(resnums) if resnums else None,
+                      min(unpnums) if unpnums else None,
+                      max(unpnums) if unpnums else None])
+    return ranges
+
   def load_pfam(self,fname):
     query  = "LOAD DATA LOCAL INFILE %s "
     query += "INTO TABLE pfam "
@@ -740,79 +969,165 @@ class PDBMapIO(PDBIO):
 
   def _alive(self,con):
     try:
-      c = con.cursor()
-      c.execute("SELECT 1")
+      con.ping()
       return True
     except:
       return False
 
-  def _connect(self,usedb=True,cursorclass=MySQLdb.cursors.DictCursor):
-    # Finally, open a cursor from the active connection
-    # Search for existing connection with desired cursorclass
-    self._con = None
-    for con in self._cons:
-      if con.cursorclass == cursorclass:
-        if self._alive(con):
-          # Set as active connection
-          self._con = con
+  def _pooled(self,cursorclass=MySQLdb.cursors.DictCursor,usedb=True):
+    """ Returns this thread's connection with the desired cursorclass,
+        checking one out of the pool if the thread does not hold one """
+    if not hasattr(self._local,'held'):
+      self._local.held = {}
+    held = self._local.held
+    con  = held.get(cursorclass,None)
+    with self._pool_lock:
+      if con and not self._usable(con):
+        del held[cursorclass]
+        self._discard(con)
+        con = None
+      if con:
+        self.pool_stats['hits'] += 1
+        self._pool_used[con] = time.time()
+    if not con:
+      con = self._checkout(cursorclass,usedb)
+      held[cursorclass] = con
+    return con
+
+  def _checkout(self,cursorclass,usedb=True):
+    """ Takes an idle connection with the desired cursorclass from the
+        pool, or opens one. At POOL_MAX open connections, the least
+        recently used idle connection is closed, or the caller waits
+        for another thread to release one. """
+    with self._pool_lock:
+      while True:
+        idle = self._pool.get(cursorclass,[])
+        if idle:
+          con = idle.pop()
+          if not self._usable(con):
+            self._discard(con)
+            continue
+          self.pool_stats['hits'] += 1
+          self._pool_used[con] = time.time()
+          return con
+        if len(self._pool_used) < PDBMapIO.POOL_MAX:
+          break
+        idle = [(self._pool_used[c],c) for cons in self._pool.values() for c in cons]
+        if idle:
+          lru = min(idle)[1]
+          for cons in self._pool.values():
+            if lru in cons:
+              cons.remove(lru)
+          self._discard(lru)
+          self.pool_stats['evictions'] += 1
         else:
-          # Remove dead connection
-          con.close()
-          self._cons.remove(con)
-    # If none was found, open a new connection with desired cursorclass
-    if not self._con:
-      trycount = 0
-      nMaxRetries = 100000
-      while (True):
-        trycount += 1
-        try:
-          if usedb:
-            if self.dbpass:
-              con = MySQLdb.connect(host=self.dbhost,
-                    user=self.dbuser,passwd=self.dbpass,
-                    db=self.dbname,cursorclass=cursorclass)
-            else:
-              con = MySQLdb.connect(host=self.dbhost,
-                    user=self.dbuser,db=self.dbname,
-                    cursorclass = cursorclass)
+          self.pool_stats['waits'] += 1
+          self._pool_lock.wait()
+      # Reserve the slot while connecting outside the lock
+      slot = object()
+      self._pool_used[slot] = time.time()
+    try:
+      con = self._open(cursorclass,usedb)
+    except:
+      with self._pool_lock:
+        del self._pool_used[slot]
+        self._pool_lock.notify_all()
+      raise
+    with self._pool_lock:
+      del self._pool_used[slot]
+      self._pool_used[con] = time.time()
+      self.pool_stats['creates'] += 1
+    return con
+
+  def release(self):
+    """ Returns the connections held by the calling thread to the pool """
+    held = getattr(self._local,'held',{})
+    with self._pool_lock:
+      for cursorclass,con in held.items():
+        self._pool.setdefault(cursorclass,[]).append(con)
+        self._pool_used[con] = time.time()
+      self._pool_lock.notify_all()
+    held.clear()
+    self._local.stmt_c = None
+    self._local.con = None
+    self._local.c   = None
+
+  def _usable(self,con):
+    """ Pings a connection only if it has been idle for a while. Called
+        with the pool lock held. """
+    if time.time() - self._pool_used[con] > PDBMapIO.POOL_IDLE_PING:
+      self.pool_stats['pings'] += 1
+      return self._alive(con)
+    self.pool_stats['pings_saved'] += 1
+    return True
+
+  def _discard(self,con):
+    """ Closes a connection and frees its slot in the pool """
+    with self._pool_lock:
+      self._pool_used.pop(con,None)
+      self._pool_lock.notify_all()
+    stmt_c = getattr(self._local,'stmt_c',None)
+    if stmt_c and stmt_c[0] is con:
+      self._local.stmt_c = None
+    try:
+      con.close()
+    except:
+      pass
+
+  def _open(self,cursorclass,usedb=True):
+    """ Opens a new database connection with the desired cursorclass """
+    trycount = 0
+    nMaxRetries = 100000
+    while (True):
+      trycount += 1
+      try:
+        if usedb:
+          if self.dbpass:
+            con = MySQLdb.connect(host=self.dbhost,
+                  user=self.dbuser,passwd=self.dbpass,
+                  db=self.dbname,cursorclass=cursorclass)
           else:
-            if self.dbpass:
-              con = MySQLdb.connect(host=self.dbhost,
-                    user=self.dbuser,passwd=self.dbpass,
-                    cursorclass = cursorclass)
-            else:
-              con = MySQLdb.connect(host=self.dbhost,
-                  user=self.dbuser,cursorclass=cursorclass)
-          # Add to connection pool and set as active connection
-          # This point is "success" from MySQLdb.connect
-          self._cons.append(con)
-          self._con = con
-          # Success... Leave while loop
-          break
-        except MySQLdb.OperationalError as e:
-          if e[0] == 1040:          
-            msg = "Unable to connect to connect to mySQL: %s\n"%e
-            sys.stderr.write(msg)
-            # If nMaxRetries, terminate with exception
-            if (trycount == nMaxRetries):
-              msg = "Max retries of %d reached\n"%nMaxRetries
-              sys.stderr.write(msg)
-              raise
-            else:
-              waitTime = 30*(1+trycount % 5)
-              msg = "Try %d failed.  Waiting %d secs and retrying...\n"%(trycount,waitTime)
-              sys.stderr.write(msg)
-              time.sleep(waitTime) # Wait 30/60/90 etc seconds and retry (return to top of while loop)
-            # Loop back through while loop
+            con = MySQLdb.connect(host=self.dbhost,
+                  user=self.dbuser,db=self.dbname,
+                  cursorclass = cursorclass)
+        else:
+          if self.dbpass:
+            con = MySQLdb.connect(host=self.dbhost,
+                  user=self.dbuser,passwd=self.dbpass,
+                  cursorclass = cursorclass)
           else:
-            # If nMaxRetries, terminate with exception
-            msg  = "\nError database connection unsuccessful: %s after %d retries\n"%(e,trycount)
-            msg += "Parameters:\n"
-            msg += " DBHOST = %s\n"%self.dbhost
-            msg += " DBNAME = %s\n"%self.dbname
-            msg += " DBUSER = %s\n\n"%self.dbuser
+            con = MySQLdb.connect(host=self.dbhost,
+                user=self.dbuser,cursorclass=cursorclass)
+        # This point is "success" from MySQLdb.connect
+        return con
+      except MySQLdb.OperationalError as e:
+        if e[0] == 1040:          
+          msg = "Unable to connect to connect to mySQL: %s\n"%e
+          sys.stderr.write(msg)
+          # If nMaxRetries, terminate with exception
+          if (trycount == nMaxRetries):
+            msg = "Max retries of %d reached\n"%nMaxRetries
             sys.stderr.write(msg)
             raise
+          else:
+            waitTime = 30*(1+trycount % 5)
+            msg = "Try %d failed.  Waiting %d secs and retrying...\n"%(trycount,waitTime)
+            sys.stderr.write(msg)
+            time.sleep(waitTime) # Wait 30/60/90 etc seconds and retry (return to top of while loop)
+          # Loop back through while loop
+        else:
+          # If nMaxRetries, terminate with exception
+          msg  = "\nError database connection unsuccessful: %s after %d retries\n"%(e,trycount)
+          msg += "Parameters:\n"
+          msg += " DBHOST = %s\n"%self.dbhost
+          msg += " DBNAME = %s\n"%self.dbname
+          msg += " DBUSER = %s\n\n"%self.dbuser
+          sys.stderr.write(msg)
+          raise
+
+  def _connect(self,usedb=True,cursorclass=MySQLdb.cursors.DictCursor):
+    # Set the pooled connection with desired cursorclass as active
+    self._con = self._pooled(cursorclass,usedb)
     # Finally, open a cursor from the active connection
     self._c = self._con.cursor() # and open a new one
     return self._c
@@ -831,24 +1146,27 @@ class PDBMapIO(PDBIO):
       self._connect(cursorclass=MySQLdb.cursors.Cursor)
     else:
       self._connect()
+    # Keep a local reference; the caller may issue other commands
+    # (replacing self._c) while this generator is still streaming
+    c = self._c
     filterwarnings('ignore', category = MySQLdb.Warning)
     try:
-      if qvars: self._c.execute(query,qvars)
-      else:     self._c.execute(query)
-      for row in self._c:
+      if qvars: c.execute(query,qvars)
+      else:     c.execute(query)
+      for row in c:
         yield row
     except Exception as e:
       msg  = "ERROR (PDBMapIO) Secure query failed; Exception: %s; "%str(e)
       msg += " Provided query: %s"%query
       msg += " Provided args: %s"%str(qvars)
-      if "_last_executed" in dir(self._c):
-        msg += "\n Executed Query: \n%s"%self._c._last_executed
+      if "_last_executed" in dir(c):
+        msg += "\n Executed Query: \n%s"%c._last_executed
       raise Exception(msg)
     finally:
-      # msg = "Executed Query: \n%s\n"%self._c._last_executed
+      # msg = "Executed Query: \n%s\n"%c._last_executed
       # print msg
       resetwarnings()
-      self._close()
+      c.close()
 
   def secure_command(self,query,qvars=None):
     """ Executes commands using safe practices """
@@ -884,6 +1202,8 @@ class PDBMapIO(PDBIO):
                 'lib/create_schema_GenomicIntersection.sql',
                 'lib/create_schema_sifts.sql',
                 'lib/create_schema_pfam.sql',
+                'lib/create_schema_LoadQueue.sql',
+                'lib/create_schema_IntersectionMark.sql',
                 'lib/create_procedure_assign_foreign_keys.sql',
                 'lib/create_procedure_get_protein.sql',
                 'lib/create_procedure_get_structure.sql',
@@ -954,6 +1274,64 @@ class PDBMapIO(PDBIO):
   # and sometimes the asymmetric unit is wanted. Retaining below:
   # AND (c.method LIKE '%%%%nmr%%%%' OR b.biounit>0 OR NOT ISNULL(d.modelid))
 
+  # Parameterized inserts used by upload_structure
+  structure_insert  = "INSERT IGNORE INTO Structure "
+  structure_insert += "(label,pdbid,method,quality,resolution,`name`,author,deposition,`release`,compound,keywords,reference,structure_reference) "
+  structure_insert += "VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)"
+  chain_insert  = "INSERT IGNORE INTO Chain "
+  chain_insert += "(label,structid,biounit,model,chain,unp,gene,offset,hybrid,sequence) "
+  chain_insert += "VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)"
+  residue_insert  = "INSERT IGNORE INTO Residue "
+  residue_insert += "(label,structid,biounit,model,chain,resname,rescode,seqid,icode,x,y,z,ss,rsa,phi,psi,tco,kappa,alpha,conflict) "
+  residue_insert += "VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)"
+  transcript_insert  = "INSERT IGNORE INTO Transcript "
+  transcript_insert += "(label,transcript,protein,gene,seqid,rescode,chr,start,end,strand) "
+  transcript_insert += "VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)"
+  alignment_insert  = "INSERT IGNORE INTO Alignment "
+  alignment_insert += "(label,structid,chain,chain_seqid,transcript,trans_seqid) "
+  alignment_insert += "VALUES (%s,%s,%s,%s,%s,%s)"
+  alignment_score_insert  = "INSERT IGNORE INTO AlignmentScore "
+  alignment_score_insert += "(label,structid,chain,transcript,score,perc_aligned,perc_identity,alignment) "
+  alignment_score_insert += "VALUES (%s,%s,%s,%s,%s,%s,%s,%s)"
+
+  # All SIFTS residue mappings for one PDB ID
+  sifts_query  = "SELECT chain,uniprot_acc,resnum,uniprot_resnum FROM sifts "
+  sifts_query += "WHERE pdbid=%s AND uniprot_acc IS NOT NULL ORDER BY chain,uniprot_acc,resnum"
+
+  # Parameterized insert and pipe load used by upload_intersection
+  intersection_insert  = "INSERT IGNORE INTO GenomicIntersection "
+  intersection_insert += "(dlabel,slabel,structid,chain,seqid,gc_id) VALUES (%s,%s,%s,%s,%s,%s)"
+  # Secondary indexes of GenomicIntersection (see create_schema_GenomicIntersection.sql)
+  # that may be dropped during large loads, as (name,columns)
+  intersection_secondary_keys = [("slabel","slabel,structid,chain,seqid,gc_id"),
+                                 ("res_id","res_id"),("gc_id","gc_id"),("gd_id","gd_id")]
+  intersection_load  = "LOAD DATA LOCAL INFILE %s IGNORE INTO TABLE GenomicIntersection "
+  intersection_load += "FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' "
+  intersection_load += "(dlabel,slabel,structid,chain,seqid,gc_id)"
+
+  # Parameterized inserts used by upload_genomic_data
+  genomic_data_insert  = "INSERT IGNORE INTO GenomicData "
+  genomic_data_insert += "(label,chr,start,end,name,variation,vtype,svtype,ref_allele,alt_allele,"
+  genomic_data_insert += "svlen,quality,avgpost,rsq,erate,theta,ldaf,ac,an,aa,da,maf,amr_af,asn_af,"
+  genomic_data_insert += "eas_af,sas_af,afr_af,eur_af,ens_gene,hgnc_gene,"
+  genomic_data_insert += "snpsource,format,gt) VALUES "
+  genomic_data_insert += "(%(LABEL)s,%(CHROM)s,%(START)s,%(END)s,%(ID)s,%(EXISTING)s,%(VT)s,"
+  genomic_data_insert += "%(SVTYPE)s,%(REF)s,%(ALT)s,%(SVLEN)s,%(QUAL)s,%(AVGPOST)s,%(RSQ)s,"
+  genomic_data_insert += "%(ERATE)s,%(THETA)s,%(LDAF)s,%(AC)s,%(AN)s,%(AA)s,%(DA)s,"
+  genomic_data_insert += "%(AF)s,%(AMR_AF)s,%(ASN_AF)s,%(EAS_AF)s,%(SAS_AF)s,%(AFR_AF)s,%(EUR_AF)s,"
+  genomic_data_insert += "%(GENE)s,%(HGNC)s,%(SNPSOURCE)s,%(FORMAT)s,%(GT)s)"
+  genomic_consequence_insert  = "INSERT IGNORE INTO GenomicConsequence "
+  genomic_consequence_insert += "(label,chr,start,end,name,transcript,protein,uniprot,canonical,allele,"
+  genomic_consequence_insert += "consequence,cdna_pos,cds_pos,protein_pos,ref_amino_acid,"
+  genomic_consequence_insert += "alt_amino_acid,ref_codon,alt_codon,polyphen,sift,biotype,"
+  genomic_consequence_insert += "domains) VALUES "
+  genomic_consequence_insert += "(%(LABEL)s,%(CHROM)s,%(START)s,%(END)s,%(ID)s,"
+  genomic_consequence_insert += "%(Feature)s,%(ENSP)s,%(SWISSPROT)s,%(CANONICAL)s,%(Allele)s,"
+  genomic_consequence_insert += "%(Consequence)s,%(cDNA_position)s,%(CDS_position)s,"
+  genomic_consequence_insert += "%(Protein_position)s,%(Ref_AminoAcid)s,%(Alt_AminoAcid)s,"
+  genomic_consequence_insert += "%(Ref_Codon)s,%(Alt_Codon)s,%(PolyPhen)s,%(SIFT)s,"
+  genomic_consequence_insert += "%(BIOTYPE)s,%(DOMAINS)s)"
+
 
 aa_code_map = {"ala" : "A",
         "arg" : "R",
@@ -10,23 +10,27 @@
 # Date           : 2014-02-27
 # Description    : Service class designed to intersect structural and 
 #                : genomic, and sequence datasets. Does not alter original 
-#                : datasets. Calculates intersection with intersectBed and 
-#                : stores the crossreference in the PDBMap.IntersectGenome 
-#                : database.
+#                : datasets. Calculates intersection by chromosome with
+#                : sorted interval arrays and stores the crossreference in
+#                : the PDBMap.GenomicIntersection table.
 #=============================================================================#
 
 # See main check for cmd line parsing
 from lib import PDBMapIO
-import sys,os,csv,random
-import subprocess as sp
+import sys,os,time
+from array import array
+import numpy as np
+from multiprocessing import Pool
 
 class PDBMapIntersect():
   def __init__(self,pdbmapio):
     """ Initialization requires a PDBMapIO object """
     self.io = pdbmapio
 
-  def quick_intersect(self,dlabel,slabel=None,dtype='Genomic'):
+  def quick_intersect(self,dlabel,slabel=None,dtype='Genomic',by_chrom=True):
     # Intersects small datasets using a mysql join
+    # If by_chrom, one INSERT per chromosome keeps each transaction (and
+    # its locks on GenomicIntersection) short
     if dtype == "Genomic":
       pass
     elif dtype == 'Protein':
@@ -48,128 +52,250 @@ class PDBMapIntersect():
     query += "ON b.transcript=c.transcript AND b.seqid=c.trans_seqid "
     query += "WHERE a.label=%s "
     if slabel:
-      query += "AND b.label=%s AND c.label=%s"
-    if slabel:
-      self.io.secure_command(query,(dlabel,slabel,slabel))
-    else:
-      self.io.secure_command(query,(dlabel,))
-    return(-1) # No row feedback for quick-intersect
+      query += "AND b.label=%s AND c.label=%s "
+    qvars = (dlabel,slabel,slabel) if slabel else (dlabel,)
+    if not by_chrom:
+      self.io.secure_command(query,qvars)
+      return(-1) # No row feedback for quick-intersect
+    query += "AND a.chr=%s"
+    nrows = 0
+    for chrom in self.chromosomes(dlabel):
+      t0 = time.time()
+      rc = self.io.secure_command(query,qvars+(chrom,))
+      print " # %s: %d intersections (%.0fs) #"%(chrom,rc,time.time()-t0)
+      nrows += rc
+    return(nrows)
 
-  def intersect(self,dlabel=None,slabel=None,dtype='Genomic',buffer_size=1):
-    # Intersects a structure set with a dataset using intersectBed
+  def intersect(self,dlabel=None,slabel=None,dtype='Genomic',buffer_size=5000,workers=1,
+                incremental=True,load_infile=False,defer_keys=False):
+    # Intersects a structure set with a dataset, one chromosome at a time.
+    # With workers > 1, chromosomes are intersected and uploaded in parallel.
+    # If incremental, only variants and alignments added since the last
+    # intersection of this (dlabel,slabel) are intersected.
+    # Rows are uploaded in batches of buffer_size, or through LOAD DATA if
+    # load_infile. If defer_keys, secondary indexes are dropped during the
+    # upload and rebuilt at the end.
     # Slow, but intersection pointers are stored permanently (1-time op)
     # dtype options: Genomic, [Protein, Structural]
-    
-    # Define the two temp filenames
-    temp1  = "temp/%d.TEMP"%multidigit_rand(10)
-    temp2  = "temp/%d.TEMP"%multidigit_rand(10)
-    try: # Ensure proper file cleanup
-      # Query and write data ranges to temp file
-      if dtype == 'Genomic':
-        query  = "SELECT a.chr,a.start-1,a.end-1,a.gc_id,a.transcript,a.label FROM "
-        query += "GenomicConsequence as a INNER JOIN GenomicData as b "
-        query += "ON a.label=b.label AND a.chr=b.chr AND a.start=b.start AND a.end=b.end "
-        if dlabel:
-          query += "WHERE a.label=%s "
-      elif dtype == 'Protein':
-        msg = "ERROR (PDBMapIntersect) Protein intersection not implemented."
-        raise Exception(msg)
-      elif dtype == 'Structural':
-        msg = "ERROR (PDBMapIntersect) Structural intersection not implemented."
-        raise Exception(msg)
+    if dtype == 'Protein':
+      msg = "ERROR (PDBMapIntersect) Protein intersection not implemented."
+      raise Exception(msg)
+    elif dtype == 'Structural':
+      msg = "ERROR (PDBMapIntersect) Structural intersection not implemented."
+      raise Exception(msg)
+    elif dtype != 'Genomic':
+      msg = "ERROR (PDBMapIntersect) %s intersection is not a valid option."
+      raise Exception(msg%dtype)
+    try:
+      # High-water marks: (previous gc_id, current gc_id, previous al_id, current al_id)
+      gc0,al0 = self.get_marks(dlabel,slabel) if incremental else (0,0)
+      gc1,al1 = self.current_marks(dlabel,slabel)
+      # IDs are assigned when rows are inserted, not when they commit, so
+      # a load still running may later commit IDs below gc1 and al1, and
+      # incremental runs would never intersect them. Any such load is an
+      # open write transaction now; transactions starting later receive
+      # higher IDs. The marks are only recorded if there is none.
+      safe    = not self.writes_in_progress()
+      marks   = (gc0,gc1,al0,al1)
+      if gc1 <= gc0 and al1 <= al0:
+        print " # No new variants or alignments since the last intersection #"
+        return(0)
+      if gc0 or al0:
+        print " # Intersecting %d new consequence IDs and %d new alignment IDs #"%(
+                  gc1-gc0,al1-al0)
+      chroms = self.chromosomes(dlabel,gc0 if al1 <= al0 else 0)
+      print " # Intersecting %d chromosomes with %d worker(s) #"%(len(chroms),workers)
+      io = self.io
+      jobs = [((io.dbhost,io.dbuser,io.dbpass,io.dbname),chrom,dlabel,slabel,
+                buffer_size,marks,load_infile) for chrom in chroms]
+      nrows = 0
+      if defer_keys:
+        self.io.intersection_keys(enable=False)
+      if workers > 1:
+        # Each worker opens its own database connections
+        pool = Pool(processes=workers)
+        try:
+          for chrom,rc,secs in pool.imap_unordered(_intersect_partition,jobs):
+            print " # %s: %d intersections (%.0fs) #"%(chrom,rc,secs)
+            nrows += rc
+          pool.close()
+        except:
+          pool.terminate()
+          raise
+        finally:
+          pool.join()
       else:
-        msg = "ERROR (PDBMapIntersect) %s intersection is not a valid option."
-        raise Exception(msg%dtype)
-      with open(temp1,'wb') as fout:
-        writer = csv.writer(fout,delimiter='\t')
-        if dlabel:
-          data = self.io.secure_query(query,(dlabel,),cursorclass='SSCursor')
-        else:
-          data = self.io.secure_query(query,cursorclass='SSCursor')
-        print " # Fetching PDBMap::GenomicConsequence,GenomicData #"
-        for row in data:
-          writer.writerow(row)
-
-      # Query and write PDBMap ranges to temp file, adjusted for UCSC indexing
-      query  = "SELECT chr,start-1,end-1,structid,chain,chain_seqid,a.transcript,a.label FROM "
-      query += "Transcript as a "
-      query += "INNER JOIN Alignment as b "
-      query += "ON a.label=b.label AND a.transcript=b.transcript AND a.seqid=b.trans_seqid "
-      if slabel:
-        query += "WHERE b.label=%s "
-      with open(temp2,'wb') as fout:
-        writer = csv.writer(fout,delimiter='\t')
-        if slabel:
-          structures = self.io.secure_query(query,(slabel,),cursorclass='SSCursor')
-        else:
-          structures = self.io.secure_query(query,cursorclass='SSCursor')
-        print " # Fetching PDBMap::Alignment,Transcript #"
-        for row in structures:
-          writer.writerow(row)
-
-      # IntersectBed is sensitive, ensure unix encoding
-      sp.check_call(["dos2unix",temp1])
-      sp.check_call(["dos2unix",temp2])
-
-      ## Temp files written. Beginning Intersection and upload. ##
-
-      # Intersect with intersectBed and upload output to PDBMap.IntersectGenome
-      print " # Performing intersection #"
-      cmd = ["intersectBed","-wb","-a",temp1,"-b",temp2]
-      p = sp.Popen(cmd,stdout=sp.PIPE)
-      parser = process_parser(p)
-      nrows = self.io.upload_intersection(parse_intersection(parser),
-                      buffer_size=buffer_size)
-
-      # Remove temp files only if no exception
-      #sp.check_call(["rm","-f",temp1])
-      #sp.check_call(["rm","-f",temp2])
-        
+        for chrom in chroms:
+          t0 = time.time()
+          rc = self.intersect_partition(chrom,dlabel,slabel,buffer_size,marks,load_infile)
+          print " # %s: %d intersections (%.0fs) #"%(chrom,rc,time.time()-t0)
+          nrows += rc
+      # Record the new high-water marks only after every partition succeeds
+      if safe:
+        self.set_marks(dlabel,slabel,gc1,al1)
+      else:
+        msg  = "WARNING (PDBMapIntersect) Database writes were in progress when the "
+        msg += "intersection started; intersection marks not updated. Re-run intersect "
+        msg += "after loads finish.\n"
+        sys.stderr.write(msg)
     except Exception as e: 
       msg  = "ERROR (PDBMapIntersect) Exception during "
       msg += "%s Intersection of %s and %s: %s"%(dtype,dlabel,slabel,str(e))
       sys.stderr.write(msg+'\n')
       raise
-      # raise Exception(msg)
     finally:
-      # # Remove temp files
-      # sp.check_call(["rm","-f",temp1])
-      # sp.check_call(["rm","-f",temp2])
-      pass
+      if defer_keys:
+        print " # Rebuilding GenomicIntersection indexes #"
+        self.io.intersection_keys(enable=True)
     return(nrows) # Return the number of intersections
-    
-## Copied from biolearn
-def multidigit_rand(digits):
-  randlist = [random.randint(1,10) for i in xrange(digits)]
-  multidigit_rand = int(''.join([str(x) for x in randlist]))
-  return multidigit_rand
 
-## Copied from snp_stats
-def process_parser(p):
-  while True:
-    line = p.stdout.readline()
-    if not line: break
-    yield line
+  def chromosomes(self,dlabel=None,gc_min=0):
+    """ Returns the chromosomes with consequences in this dataset,
+        optionally only those with gc_id greater than gc_min """
+    query = "SELECT DISTINCT chr FROM GenomicConsequence WHERE gc_id>%s "
+    if dlabel:
+      query += "AND label=%s"
+      res = self.io.secure_query(query,(gc_min,dlabel),cursorclass='Cursor')
+    else:
+      res = self.io.secure_query(query,(gc_min,),cursorclass='Cursor')
+    return sorted(r[0] for r in res)
+
+  def get_marks(self,dlabel=None,slabel=None):
+    """ Returns the (gc_id,al_id) high-water marks of the last intersection """
+    query = "SELECT gc_max,al_max FROM IntersectionMark WHERE dlabel=%s AND slabel=%s"
+    res = [r for r in self.io.secure_query(query,(dlabel or '',slabel or ''),cursorclass='Cursor')]
+    return (int(res[0][0]),int(res[0][1])) if res else (0,0)
+
+  def current_marks(self,dlabel=None,slabel=None):
+    """ Returns the current maximum gc_id and al_id for these labels """
+    query = "SELECT MAX(gc_id) FROM GenomicConsequence "
+    if dlabel:
+      query += "WHERE label=%s"
+      res = self.io.secure_query(query,(dlabel,),cursorclass='Cursor')
+    else:
+      res = self.io.secure_query(query,cursorclass='Cursor')
+    gc_max = [r[0] for r in res][0] or 0
+    query = "SELECT MAX(al_id) FROM Alignment "
+    if slabel:
+      query += "WHERE label=%s"
+      res = self.io.secure_query(query,(slabel,),cursorclass='Cursor')
+    else:
+      res = self.io.secure_query(query,cursorclass='Cursor')
+    al_max = [r[0] for r in res][0] or 0
+    return int(gc_max),int(al_max)
+
+  def writes_in_progress(self):
+    """ True if any InnoDB transaction on the server holds table locks or
+        modified rows, i.e. may hold uncommitted AUTO_INCREMENT IDs. Covers
+        every kind of load (queued, --workers, --ppart, single IDs, and
+        load_data). Also True if the server cannot be checked. """
+    query  = "SELECT COUNT(*) FROM information_schema.INNODB_TRX "
+    query += "WHERE trx_tables_locked>0 OR trx_rows_modified>0"
+    try:
+      res = self.io.secure_query(query,cursorclass='Cursor')
+      return [r[0] for r in res][0] > 0
+    except Exception as e:
+      msg = "WARNING (PDBMapIntersect) Unable to check for open transactions: %s\n"%str(e)
+      sys.stderr.write(msg)
+      return True
 
-## Adapted from snp_stats
-def parse_intersection(parser):
-  for line in parser:
-    line = line.strip()
-    if not line or line[0] == "#": continue
-    row = line.split('\t')
-    if len(row) < 14:
-      # No transcript info from GenomicConsequence
-      d_chr,d_start,d_end,gc_id,d_label,t_chr,t_start,t_end, \
-      pdbid,chain,seqid,t_trans,slabel = row
+  def set_marks(self,dlabel,slabel,gc_max,al_max):
+    """ Records the high-water marks of a completed intersection """
+    query  = "INSERT INTO IntersectionMark (dlabel,slabel,gc_max,al_max) VALUES (%s,%s,%s,%s) "
+    query += "ON DUPLICATE KEY UPDATE gc_max=VALUES(gc_max),al_max=VALUES(al_max)"
+    self.io.secure_command(query,(dlabel or '',slabel or '',gc_max,al_max))
+
+  def intersect_partition(self,chrom,dlabel=None,slabel=None,buffer_size=5000,marks=None,
+                          load_infile=False):
+    """ Intersects and uploads one chromosome. Returns the row count.
+        Given marks (gc0,gc1,al0,al1), only new variants against all
+        alignments, and old variants against new alignments, are intersected. """
+    if not marks:
+      passes = [(None,None)]
     else:
-      # Transcript checks only if transcript info available
-      d_chr,d_start,d_end,gc_id,d_trans,d_label,t_chr,t_start,t_end, \
-      pdbid,chain,seqid,t_trans,s_label = row
-      if d_trans and d_trans != t_trans: continue # Not the same transcript
-    seqid = int(seqid)
-    gc_id = int(gc_id)
-    # Return the direct reference
-    yield (d_label,s_label,pdbid,chain,seqid,gc_id)
+      gc0,gc1,al0,al1 = marks
+      passes = []
+      if gc1 > gc0:
+        passes.append(((gc0,gc1),(0,al1)))
+      if al1 > al0 and gc0 > 0:
+        passes.append(((0,gc0),(al0,al1)))
+    nrows = 0
+    for gc_range,al_range in passes:
+      nrows += self.io.upload_intersection(self.intersect_chromosome(chrom,dlabel,slabel,
+                        gc_range,al_range),buffer_size=buffer_size,load_infile=load_infile)
+    return nrows
+
+  def intersect_chromosome(self,chrom,dlabel=None,slabel=None,gc_range=None,al_range=None):
+    """ Generator: intersects the variants and aligned transcript residues
+        of one chromosome. Yields GenomicIntersection rows. Optional
+        (low,high] ID ranges restrict the variants and alignments. """
+    # Aligned residue ranges, UCSC indexing, sorted by start
+    query  = "SELECT a.start-1,a.end-1,structid,chain,chain_seqid,a.transcript,a.label FROM "
+    query += "Transcript as a "
+    query += "INNER JOIN Alignment as b "
+    query += "ON a.label=b.label AND a.transcript=b.transcript AND a.seqid=b.trans_seqid "
+    query += "WHERE a.chr=%s "
+    qvars  = [chrom]
+    if slabel:
+      query += "AND b.label=%s "
+      qvars.append(slabel)
+    if al_range:
+      query += "AND b.al_id>%s AND b.al_id<=%s "
+      qvars.extend(al_range)
+    res = self.io.secure_query(query,tuple(qvars),cursorclass='SSCursor')
+    # Residues are held in typed arrays. Each refers by index to its
+    # distinct (structid,chain,transcript,label), of which there are few.
+    starts,ends,seqids,kidx = array('l'),array('l'),array('l'),array('l')
+    keys,keyidx = [],{}
+    for t_start,t_end,structid,chain,seqid,t_trans,s_label in res:
+      key = (structid,chain,t_trans,s_label)
+      if key not in keyidx:
+        keyidx[key] = len(keys)
+        keys.append(key)
+      starts.append(t_start)
+      ends.append(t_end)
+      seqids.append(seqid)
+      kidx.append(keyidx[key])
+    if not starts: return
+    order  = np.argsort(np.frombuffer(starts,dtype='l'),kind='mergesort')
+    starts = np.frombuffer(starts,dtype='l')[order]
+    ends   = np.frombuffer(ends,dtype='l')[order]
+    seqids = np.frombuffer(seqids,dtype='l')[order]
+    kidx   = np.frombuffer(kidx,dtype='l')[order]
+    # Any residue overlapping a variant must start within this distance
+    maxlen = max(int((ends-starts).max()),1)
+
+    # Variant ranges, UCSC indexing
+    query  = "SELECT a.start-1,a.end-1,a.gc_id,a.transcript,a.label FROM "
+    query += "GenomicConsequence as a INNER JOIN GenomicData as b "
+    query += "ON a.label=b.label AND a.chr=b.chr AND a.start=b.start AND a.end=b.end "
+    query += "WHERE a.chr=%s "
+    qvars  = [chrom]
+    if dlabel:
+      query += "AND a.label=%s "
+      qvars.append(dlabel)
+    if gc_range:
+      query += "AND a.gc_id>%s AND a.gc_id<=%s "
+      qvars.extend(gc_range)
+    data = self.io.secure_query(query,tuple(qvars),cursorclass='SSCursor')
+    for d_start,d_end,gc_id,d_trans,d_label in data:
+      d_end = max(d_end,d_start+1) # zero-length ranges cover one base
+      lo = np.searchsorted(starts,d_start-maxlen+1,side='left')
+      hi = np.searchsorted(starts,d_end,side='left')
+      for k in xrange(lo,hi):
+        if ends[k] <= d_start: continue # ends before the variant
+        pdbid,chain,t_trans,s_label = keys[kidx[k]]
+        if d_trans and d_trans != t_trans: continue # Not the same transcript
+        # Return the direct reference
+        yield (d_label,s_label,pdbid,chain,int(seqids[k]),int(gc_id))
+
+def _intersect_partition(job):
+  """ Pool worker: intersects one chromosome with a new database connection """
+  dbargs,chrom,dlabel,slabel,buffer_size,marks,load_infile = job
+  t0 = time.time()
+  io = PDBMapIO(*dbargs,dlabel=dlabel or "",slabel=slabel or "")
+  rc = PDBMapIntersect(io).intersect_partition(chrom,dlabel,slabel,buffer_size,marks,load_infile)
+  return chrom,rc,time.time()-t0
 
 # Main check
 if __name__== "__main__":
@@ -0,0 +1,77 @@
+#!/usr/bin/env python2.7
+#
+# Project        : PDBMap
+# Filename       : PDBMapJournal.py
+# Author         : agent
+# Organization   : Center for Human Genetics Research,
+#                : Department of Biomedical Informatics,
+#                : Vanderbilt University Medical Center
+# Email          : agent@local
+# Date           : 2026-10-18
+# Description    : Append-only status journal for bulk loads. One
+#                : tab-delimited line per processed ID records the
+#                : outcome (VALID/ERROR/SKIP), duration, and reason, so
+#                : that interrupted loads may be resumed without
+#                : re-querying the database.
+#=============================================================================#
+
+# See main check for cmd line parsing
+import sys,os,time
+
+class PDBMapJournal():
+  # Outcomes which need not be repeated on resume
+  COMPLETE = ("VALID","SKIP")
+
+  def __init__(self,fname):
+    """ Initialization requires the journal file location """
+    self.fname = fname
+    self._fout = None
+    self._pid  = None
+
+  def record(self,cmd,label,eid,status,duration=0.,reason=""):
+    """ Appends the outcome for one ID """
+    # Each process opens its own handle; lines are written in a single
+    # append so that concurrent workers do not interleave records
+    if self._pid != os.getpid():
+      self._fout = open(self.fname,'a')
+      self._pid  = os.getpid()
+    reason = ' '.join(str(reason).split()) # one line, no tabs
+    row = [time.strftime("%Y-%m-%d %H:%M:%S"),cmd,label,eid,status,"%.2f"%duration,reason]
+    self._fout.write("%s\n"%'\t'.join(row))
+    self._fout.flush()
+
+  def status(self,cmd,label):
+    """ Returns the most recent status of each ID for this command and label """
+    last = {}
+    if not os.path.exists(self.fname):
+      return last
+    with open(self.fname,'rb') as fin:
+      for line in fin:
+        row = line.rstrip('\n').split('\t')
+        if len(row) < 5: continue # partial line from an interrupted write
+        if row[1] == cmd and row[2] == label:
+          last[row[3]] = row[4]
+    return last
+
+  def completed(self,cmd,label):
+    """ Returns the set of IDs whose last recorded outcome was complete """
+    return set(eid for eid,s in self.status(cmd,label).iteritems() if s in PDBMapJournal.COMPLETE)
+
+  def failed(self,cmd,label):
+    """ Returns the set of IDs whose last recorded outcome was an error """
+    return set(eid for eid,s in self.status(cmd,label).iteritems() if s == "ERROR")
+
+  def filter(self,cmd,label,eids,retry_failed=False):
+    """ Removes completed IDs, or keeps only failed IDs if retry_failed """
+    if retry_failed:
+      keep = self.failed(cmd,label)
+      eids = [eid for eid in eids if eid in keep]
+    else:
+      done = self.completed(cmd,label)
+      eids = [eid for eid in eids if eid not in done]
+    return eids
+
+# Main check
+if __name__== "__main__":
+  sys.stderr.write("Class definition. Should not be called from command line.\n")
+  sys.exit(1)
@@ -14,14 +14,19 @@
 
 # See main check for cmd line parsing
 import sys,os,csv,collections,gzip,time,random
+import cStringIO
 import subprocess as sp
 from Bio.PDB.PDBParser import PDBParser
 from Bio.PDB.PDBIO import PDBIO
 import Bio.PDB
+from Bio.PDB.Structure import Structure
+from Bio.PDB.Model import Model
+from Bio.PDB.Chain import Chain
+from Bio.PDB.Residue import Residue
 import numpy as np
 from lib.PDBMapModel import PDBMapModel
 from lib.PDBMapProtein import PDBMapProtein
-from lib.PDBMapStructure import PDBMapStructure
+from lib.PDBMapStructure import PDBMapStructure,PDBMapResidueTable,PDBMapResidue
 from lib.PDBMapIO import PDBMapIO,aa_code_map
 import MySQLdb, MySQLdb.cursors
 from warnings import filterwarnings,resetwarnings
@@ -45,15 +50,12 @@ class PDBMapParser(PDBParser):
     if not biounit:
       for m in iter_s[1:]:
         s.detach_child(m.id) # Retain only the first model
-    # Record the biological assembly ID for each entity
+    # Record the biological assembly ID for each model and chain
+    # (residues record it in the residue table)
     for m in s:
       m.biounit = biounit
       for c in m:
         c.biounit = biounit
-        for r in m:
-          r.biounit = biounit
-          for a in r:
-            a.biounit = biounit
     iter_s = [m for m in s]
     for m in iter_s:
       iter_m = [c for c in m] # avoid modification during iteration, shallow
@@ -94,40 +96,164 @@ class PDBMapParser(PDBParser):
             # Assign a 1-letter amino acid code
             if 'resname' not in dir(r) or r.resname.lower() not in aa_code_map:
               r.resname='SER' # if unknown, dummy code serine for alignment
-            r.rescode = aa_code_map[r.resname.lower()]
-            # Compute the center of mass for all residues
-            natom = len([a for a in r])
-            r.coord  = sum([a.coord for a in r]) / natom
-            # Save the structural coordinate independently
-            r.x,r.y,r.z = r.coord
-            # Save the sequence coordinates independently
-            _,r.seqid,r.icode = r.id
         if not len(c): # If chain contained only heteroatoms
           m.detach_child(c.id) # Remove chain
-        else:
-          # Parse the chain sequence and store as string within the chain
-          c.sequence = ''.join([r.rescode for r in c])
       if not len(m): # If the model only contained non-human species
         s.detach_child(m.id)
     if not len(s):
       msg = "ERROR (PDBMapIO) %s contains no human protein chains."%s.id
       raise Exception(msg)
+    # Store the annotations of all retained residues in one table
+    resis = [r for r in s.get_residues()]
+    bound = np.array([isinstance(r,PDBMapResidue) for r in resis])
+    table = PDBMapResidueTable(len(resis))
+    for i,r in enumerate(resis):
+      table.bind(r,i)
+    table.cols['biounit'][:] = biounit
+    table.cols['rescode'][:] = [aa_code_map[r.resname.lower()] for r in resis]
+    table.cols['seqid'][:]   = [r.id[1] for r in resis]
+    table.cols['icode'][:]   = [r.id[2] for r in resis]
+    # Compute the center of mass for all residues with atoms. Residues
+    # from read_structure have no atoms and keep their stored centroid.
+    natom = np.array([len(r) for r in resis])
+    if natom.sum():
+      coord  = np.array([a.coord for r in resis for a in r],dtype='f4')
+      starts = np.concatenate(([0],np.cumsum(natom)[:-1]))
+      table.coord[natom>0] = np.add.reduceat(coord,starts[natom>0]) / natom[natom>0,None]
+    table.coord[(natom==0) & ~bound] = np.nan
+    s.restable = table
+    # Parse the chain sequence and store as string within the chain
+    for m in s:
+      for c in m:
+        c.sequence = ''.join([r.rescode for r in c])
     return s
 
   @classmethod
-  def getBiopythonStructureOrFail(cls,modelid,fname):
-    functionNameAsString = sys._getframe().f_code.co_name
+  def read_pdb_file(cls,fname):
+    """ Returns the decompressed contents of a PDB file. Read once and
+        shared by the parser, the header scans, and DSSP. """
     ext = os.path.basename(fname).split('.')[-1]
+    # Uncompressed biological assemblies are named xxxx.pdbN
+    biounit = ext[:3] == 'pdb' and ext[3:].isdigit()
+    if ext not in ['gz','txt','pdb','ent'] and not biounit:
+      msg = "   ERROR (PDBMapParser) Unsupported file type: %s.\n"%fname
+      raise Exception(msg)
     try:
       if ext == 'gz':
         fin = gzip.open(fname,'rb')
-      elif ext in ['txt','pdb','ent']:
-        fin = open(fname,'rb')
       else:
-        msg = "   ERROR (PDBMapParser) Unsupported file type: %s.\n"%fname
-        raise Exception(msg)
+        fin = open(fname,'rb')
+      data = fin.read()
+      fin.close()
     except Exception as e:
-      raise "In %s, could not open file %s"%(functioNameAsString,fname)
+      msg = "   ERROR (PDBMapParser) Could not read file %s: %s"%(fname,str(e))
+      raise Exception(msg)
+    return data
+
+  @classmethod
+  def read_atoms(cls,lines):
+    """ Reads the coordinate records of a PDB file into per-atom arrays.
+        Only the first alternate location of each atom is retained. """
+    recs = [l for l in lines if l[:6] in ('ATOM  ','HETATM','MODEL ')]
+    names = ['model','hetatm','name','resname','chain','resseq','icode','coord']
+    if not recs:
+      return dict((k,np.zeros((0,3) if k=='coord' else 0)) for k in names)
+    buf = np.array([l.rstrip('\r\n').ljust(80) for l in recs],dtype='S80')
+    buf = buf.view('S1').reshape(len(recs),80)
+    def col(a,b):
+      return buf[:,a:b].copy().view('S%d'%(b-a)).ravel()
+    # Models are numbered from 0 in order of their MODEL records
+    rtype = col(0,6)
+    model = np.maximum(np.cumsum(rtype=='MODEL ')-1,0)
+    atom  = rtype!='MODEL '
+    buf,rtype,model = buf[atom],rtype[atom],model[atom]
+    atoms = {'model'   : model,
+             'hetatm'  : rtype=='HETATM',
+             'name'    : np.char.strip(col(12,16)),
+             'resname' : np.char.strip(col(17,20)),
+             'chain'   : col(21,22),
+             'resseq'  : col(22,26).astype(int),
+             'icode'   : col(26,27),
+             'coord'   : np.column_stack((col(30,38).astype(float),
+                                          col(38,46).astype(float),
+                                          col(46,54).astype(float))).astype('f4')}
+    atoms['chain'][atoms['chain']==''] = ' '
+    atoms['icode'][atoms['icode']==''] = ' '
+    # Drop all but the first alternate location of each atom, identified
+    # by chain|resseq|icode|name|model
+    altloc = col(16,17)
+    alt = np.where((altloc!='') & (altloc!=' '))[0]
+    if len(alt):
+      key = atoms['chain'][alt]
+      for part in (atoms['resseq'][alt].astype('S8'),atoms['icode'][alt],
+                   atoms['name'][alt],atoms['model'][alt].astype('S8')):
+        key = np.char.add(np.char.add(key,'|'),part)
+      _,first = np.unique(key,return_index=True)
+      keep = np.ones(len(altloc),dtype=bool)
+      keep[alt] = False
+      keep[alt[first]] = True
+      atoms = dict((k,v[keep]) for k,v in atoms.iteritems())
+    return atoms
+
+  @classmethod
+  def read_structure(cls,structid,fname,data=None):
+    """ Builds the Structure/Model/Chain/Residue hierarchy of a PDB file
+        from per-atom arrays. No Atom objects are created; each residue's
+        center of mass is held in the structure's residue table, and
+        heteroatom residues are omitted (chains are still created). Atoms
+        are parsed on demand by PDBMapStructure.atomic. """
+    if data is None:
+      data = PDBMapParser.read_pdb_file(fname)
+    lines = data.splitlines(True)
+    # Parse the header records only
+    i = next((i for i,line in enumerate(lines) if line[:6] in ('ATOM  ','HETATM','MODEL ')),len(lines))
+    filterwarnings('ignore',category=PDBConstructionWarning)
+    header = Bio.PDB.parse_pdb_header(cStringIO.StringIO(''.join(lines[:i])))
+    resetwarnings()
+    atoms = PDBMapParser.read_atoms(lines[i:])
+    s = Structure(structid)
+    s.header = header
+    s.source = fname
+    # Residues begin wherever the model, chain, or residue ID changes
+    n = len(atoms['model'])
+    if n:
+      change = np.zeros(n,dtype=bool)
+      change[0] = True
+      for k in ('model','hetatm','chain','resseq','icode'):
+        change[1:] |= atoms[k][1:] != atoms[k][:-1]
+      starts = np.where(change)[0]
+    else:
+      starts = np.zeros(0,dtype=int)
+    natom  = np.diff(np.append(starts,n))
+    center = np.add.reduceat(atoms['coord'],starts) / natom[:,None] if n else np.zeros((0,3))
+    resis  = []
+    for j,i in enumerate(starts):
+      mid,cid = int(atoms['model'][i]),str(atoms['chain'][i])
+      if mid not in s:
+        s.add(Model(mid,mid+1))
+      if cid not in s[mid]:
+        s[mid].add(Chain(cid))
+      if atoms['hetatm'][i]:
+        continue # heteroatom residue
+      rid = (' ',int(atoms['resseq'][i]),str(atoms['icode'][i]))
+      if rid in s[mid][cid]:
+        continue # non-contiguous duplicate; first is retained
+      r = Residue(rid,str(atoms['resname'][i]),'    ')
+      s[mid][cid].add(r)
+      resis.append((r,j))
+    table = PDBMapResidueTable(len(resis))
+    for row,(r,j) in enumerate(resis):
+      table.bind(r,row)
+    table.coord[:] = center[[j for r,j in resis]]
+    s.restable = table
+    return s
+
+  @classmethod
+  def getBiopythonStructureOrFail(cls,modelid,fname,data=None):
+    functionNameAsString = sys._getframe().f_code.co_name
+    if data is None:
+      data = PDBMapParser.read_pdb_file(fname)
+    fin = cStringIO.StringIO(data)
     try:
       p = PDBParser()
       filterwarnings('ignore',category=PDBConstructionWarning)
@@ -139,10 +265,11 @@ class PDBMapParser(PDBParser):
     return s
 
   def get_structure(self,pdbid,fname,biounit_fnames=[],quality=-1,io=None):
-    s = PDBMapParser.getBiopythonStructureOrFail(pdbid,fname)
+    # Decompress the file once for all consumers
+    data = PDBMapParser.read_pdb_file(fname)
+    s = PDBMapParser.read_structure(pdbid,fname,data)
     try:
       s = PDBMapStructure(s,quality,pdb2pose={})
-      fin.close()
     except Exception as e:
       msg = "ERROR (PDBMapIO) Error while parsing %s: %s"%(pdbid,str(e).replace('\n',' '))
       raise Exception(msg)
@@ -173,40 +300,34 @@ class PDBMapParser(PDBParser):
     if not s.header['resolution']:
       s.header['resolution'] = -1.0
  
-    # Load the contents of the PDB file
-    ext = os.path.basename(fname).split('.')[-1]
-    if ext == 'gz':
-      fin = [l for l in gzip.open(fname,'rb')]
-    else:
-      fin = [l for l in open(fname,'rb')]
+    # Split the contents of the PDB file into records
+    fin = data.splitlines(True)
 
     # Extract the SEQADV information and annotate any conflict residues
     for r in s.get_residues():
       if "conflict" not in dir(r):
         r.conflict = None # Initialize all residues to null conflict
-    seqadv = [line for line in fin if line.startswith("SEQADV") and
-                line[24:28].strip() == "UNP"]
-    # Assign each conflict to the associated residue
-    for row in seqadv:
-      chain  = row[16]
+    # Conflicts keyed on (chain,seqid), shared with the biounit files below
+    seqadv = {}
+    for row in fin:
+      if not row.startswith("SEQADV") or row[24:28].strip() != "UNP":
+        continue
       try:
         seqid  = int(row[18:22])
       except:
         # This SEQADV marks a deletion, which has no PDB position
         continue # Skip this entry and proceed to next
-      cnflct = row[49:70].strip()
+      seqadv[(row[16],seqid)] = row[49:70].strip()
+    # Assign each conflict to the associated residue
+    for (chain,seqid),cnflct in seqadv.iteritems():
       if chain in s[0] and seqid in s[0][chain]:
         s[0][chain][seqid].conflict = cnflct
 
     # Extract the DBREF information or query from SIFTS
     dbref_fields = []
     if io:
-      # Query structure-protein alignment information from SIFTS
-      q  = "SELECT chain,uniprot_acc,min(resnum),max(resnum), "
-      q += "min(uniprot_resnum),max(uniprot_resnum) FROM sifts "
-      q += "WHERE pdbid=%s AND uniprot_acc!='' group by chain,uniprot_acc"
-      res = io.secure_query(q,(pdbid,),cursorclass='Cursor')
-      dbref_fields = [list(r) for r in res]
+      # Structure-protein alignment information from SIFTS
+      dbref_fields = io.sifts_ranges(pdbid)
     # if len(dbref_fields) < 1:
       # # Attempt to parse DBREF fields if SIFTS unavailable
       # dbref_fields = [line for line in fin if line[0:6]=="DBREF " and
@@ -305,7 +426,7 @@ class PDBMapParser(PDBParser):
     m = s[0]
     # Calculate relative solvent accessibility for this model
     ssrsa = {}
-    resinfo = PDBMapIO.dssp(m,fname,dssp_executable='dssp')
+    resinfo = PDBMapIO.dssp(m,fname,dssp_executable='dssp',lines=fin)
     for c in m:
       for r in c:
         if (c.id,r.seqid,r.icode) not in resinfo:
@@ -322,13 +443,28 @@ class PDBMapParser(PDBParser):
         ssrsa[(c.id,r.seqid,r.icode)] = (r.ss,r.rsa,r.phi,r.psi,r.tco,r.k,r.a)
 
     # Process the biological assemblies for this structure
+    biomt = PDBMapParser.read_biomt(fin)
+    merges = [] # (table,residues) of each biounit, merged once at the end
     for biounit_fname in biounit_fnames:
+      if os.path.basename(biounit_fname).split('.')[-1] == 'gz':
+        bioid = int(os.path.basename(biounit_fname).split('.')[-2][3:])
+      else:
+        bioid = int(os.path.basename(biounit_fname).split('.')[-1][3:])
+      if biomt.get(bioid,None):
+        # Generate the assembly from the asymmetric unit
+        print "   # Assembling biounit %d"%bioid
+        models,table,resis = PDBMapParser.assemble_biounit(s,bioid,biomt[bioid])
+        if not models:
+          msg = "   ERROR (PDBMapIO) Biological assembly %s.%d contains no human protein chains.\n"%(pdbid,bioid)
+          sys.stderr.write(msg)
+          continue
+        merges.append((table,resis))
+        for m in models:
+          s.add(m)
+        continue
+      # Otherwise, parse the biological assembly file
       try:
-        biounit = PDBMapParser.getBiopythonStructureOrFail(pdbid,fname)
-        if os.path.basename(biounit_fname).split('.')[-1] == 'gz':
-          bioid = int(os.path.basename(biounit_fname).split('.')[-2][3:])
-        else:
-          bioid = int(os.path.basename(biounit_fname).split('.')[-1][3:])
+        biounit = PDBMapParser.read_structure(pdbid,biounit_fname)
         biounit = PDBMapStructure(biounit,pdb2pose={}) # must pass empty dictionary: python bug
       except Exception as e:
         msg = "   ERROR (PDBMapIO) Error while parsing %s biounit %d: %s"%(pdbid,bioid,str(e).replace('\n',' '))
@@ -339,27 +475,109 @@ class PDBMapParser(PDBParser):
         msg = "   ERROR (PDBMapIO) Biological assembly %s.%d contains no human protein chains.\n"%(pdbid,bioid)
         sys.stderr.write(msg)
         continue
+      # The biounit residues move into the structure's residue table below
+      merges.append((biounit.restable,list(biounit.get_residues())))
       # Add the models for this biological assembly to the PDBMapStructure
       for m in biounit:
+        # Atoms of this model are parsed from the biounit file on demand
+        m.source,m.source_id = biounit_fname,m.id
         m.id = "%d.%d"%(m.biounit,m.id)
         for c in m:
           for r in c:
             r.ss,r.rsa,r.phi,r.psi,r.tco,r.k,r.a = ssrsa[(c.id,r.seqid,r.icode)]
-            if (c.id,r.id[1]) in seqadv:
-              r.conflict = seqadv[(c.id,r.id[1])]
-            else:
-              r.conflict = None
+            r.conflict = seqadv.get((c.id,r.id[1]),None)
         s.add(m)
+    # Move all biounit residues into the structure's residue table at once
+    s.restable.merge(merges)
     return s
 
   @classmethod
-  def process_structure_dssp_unp2hgnc(cls, m, model_summary,fname,unp=None):
+  def read_biomt(cls,lines):
+    """ Reads the REMARK 350 transformations of each biological assembly
+        as {biounit : [(chains,rotation,translation),...]} """
+    biomt  = {}
+    bioid  = None
+    chains = []
+    for line in lines:
+      if not line.startswith("REMARK 350"):
+        continue
+      if "BIOMOLECULE:" in line:
+        bioid = int(line.split(':')[1])
+        biomt[bioid] = []
+        chains = []
+      elif bioid is None:
+        continue
+      elif "APPLY THE FOLLOWING TO CHAINS:" in line:
+        chains = [c.strip() for c in line.split(':')[1].split(',') if c.strip()]
+      elif "AND CHAINS:" in line:
+        chains.extend([c.strip() for c in line.split(':')[1].split(',') if c.strip()])
+      elif line[13:18] == "BIOMT":
+        row  = int(line[18])
+        vals = [float(v) for v in line.split()[4:8]]
+        if row == 1:
+          mat = [vals]
+        else:
+          mat.append(vals)
+        if row == 3:
+          mat = np.array(mat)
+          biomt[bioid].append((list(chains),mat[:,:3],mat[:,3]))
+    return biomt
+
+  @classmethod
+  def assemble_biounit(cls,s,bioid,ops):
+    """ Generates the models of a biological assembly from the processed
+        asymmetric unit. Residue annotations are copied from the asymmetric
+        unit and each operator is applied to the residue centroids. Returns
+        the models, their residue table, and their residues. """
+    asym = s[0]
+    models,resis,rows,opidx = [],[],[],[]
+    for k,(chains,rot,trans) in enumerate(ops):
+      m = Model("%d.%d"%(bioid,k))
+      m.biounit = bioid
+      m.transform = (rot,trans) # regenerates atoms in PDBMapStructure.atomic
+      for cid in chains:
+        if cid not in asym or cid in m:
+          continue # chain removed from the asymmetric unit
+        ac = asym[cid]
+        c  = Chain(cid)
+        for attr in ('unp','gene','pdbstart','pdbend','offset','species','hybrid','sequence'):
+          if attr in ac.__dict__:
+            setattr(c,attr,getattr(ac,attr))
+        c.biounit = bioid
+        for r in ac:
+          c.add(Residue(r.id,r.resname,r.segid))
+          rows.append(r._row)
+          opidx.append(k)
+        resis.extend(c)
+        m.add(c)
+      if len(m):
+        models.append(m)
+    src   = s.restable
+    rows  = np.array(rows,dtype=int)
+    opidx = np.array(opidx,dtype=int)
+    table = PDBMapResidueTable(len(rows))
+    for name,dtype in PDBMapResidueTable.FIELDS:
+      table.cols[name][:] = src.cols[name][rows]
+    table.cols['biounit'][:] = bioid
+    for row,orow in enumerate(rows):
+      if orow in src.conflict:
+        table.conflict[row] = src.conflict[orow]
+    if len(rows):
+      rot   = np.array([op[1] for op in ops])
+      trans = np.array([op[2] for op in ops])
+      table.coord[:] = np.einsum('nij,nj->ni',rot[opidx],src.coord[rows]) + trans[opidx]
+    for row,r in enumerate(resis):
+      table.bind(r,row)
+    return models,table,resis
+
+  @classmethod
+  def process_structure_dssp_unp2hgnc(cls, m, model_summary,fname,unp=None,lines=None):
     unp = unp if unp else model_summary['unp']
     s = PDBMapParser.process_structure(m)
     m = s[0]
     s.unp = unp
     m.unp = unp
-    resinfo = PDBMapIO.dssp(m,fname,dssp_executable='dssp')
+    resinfo = PDBMapIO.dssp(m,fname,dssp_executable='dssp',lines=lines)
     n = 0
     for c in m:
       c.unp  = unp
@@ -0,0 +1,137 @@
+#!/usr/bin/env python2.7
+#
+# Project        : PDBMap
+# Filename       : PDBMapQueue.py
+# Author         : agent
+# Organization   : Center for Human Genetics Research,
+#                : Department of Biomedical Informatics,
+#                : Vanderbilt University Medical Center
+# Email          : agent@local
+# Date           : 2026-10-18
+# Description    : Shared work queue for parallel loads. Cooperating tasks
+#                : lease small batches of IDs from the PDBMap.LoadQueue
+#                : table. The leases held by a task are renewed by a
+#                : heartbeat; leases that are not renewed expire and are
+#                : returned to the queue for another task. IDs whose load
+#                : was started too many times are marked failed.
+#=============================================================================#
+
+# See main check for cmd line parsing
+import sys,os,socket,random,threading
+
+class PDBMapQueue():
+  def __init__(self,pdbmapio,queue,lease_size=5,lease_time=600,max_attempts=3):
+    """ Initialization requires a PDBMapIO object and a queue name """
+    self.io         = pdbmapio
+    self.queue      = queue
+    self.lease_size = lease_size # IDs per lease
+    self.lease_time = lease_time # seconds without a heartbeat before expiry
+    self.max_attempts = max_attempts # started loads before an ID is marked failed
+    # Uniquely identify this process as the lease holder
+    self.worker = "%s:%d:%d"%(socket.gethostname(),os.getpid(),random.randint(0,1e9))
+    self._current = None # ID currently being loaded
+
+  def __iter__(self):
+    """ Generator: yields leased IDs until the queue is exhausted """
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=self._heartbeat,args=(stop,))
+    heartbeat.daemon = True
+    heartbeat.start()
+    try:
+      while True:
+        eids = self.lease()
+        if not eids: break
+        for eid in eids:
+          # Skip IDs whose lease expired and were taken by another task.
+          # Only IDs handed to the loader count as an attempt.
+          if not self.renew(eid,attempt=True): continue
+          self._current = eid
+          yield eid
+          self._current = None
+          self.complete(eid)
+    finally:
+      stop.set()
+
+  def _heartbeat(self,stop):
+    """ Renews the leases on the current ID and on the rest of the batch
+        queued behind it until stopped. Uses its own database connection. """
+    io = self.io.__class__(self.io.dbhost,self.io.dbuser,self.io.dbpass,self.io.dbname)
+    while not stop.wait(self.lease_time/4.):
+      self.renew_all(io)
+
+  def populate(self,eids,buffer_size=1000):
+    """ Adds IDs to the queue. IDs already queued are unchanged. """
+    eids = list(eids)
+    queryh = "INSERT IGNORE INTO LoadQueue (queue,eid) VALUES "
+    for i in range(0,len(eids),buffer_size):
+      chunk = eids[i:i+buffer_size]
+      query = queryh + ','.join(["(%s,%s)"]*len(chunk))
+      args  = [v for eid in chunk for v in (self.queue,eid)]
+      self.io.secure_command(query,args)
+    return self.size()
+
+  def size(self):
+    """ Returns the number of IDs in the queue """
+    query = "SELECT COUNT(*) FROM LoadQueue WHERE queue=%s"
+    return [r[0] for r in self.io.secure_query(query,(self.queue,),cursorclass='Cursor')][0]
+
+  def remaining(self):
+    """ Returns the number of IDs not yet completed or failed """
+    query = "SELECT COUNT(*) FROM LoadQueue WHERE queue=%s AND status NOT IN ('done','failed')"
+    return [r[0] for r in self.io.secure_query(query,(self.queue,),cursorclass='Cursor')][0]
+
+  def failed(self):
+    """ Returns the IDs whose load was started on every allowed attempt
+        without completing """
+    query = "SELECT eid FROM LoadQueue WHERE queue=%s AND status='failed' ORDER BY lq_id"
+    return [r[0] for r in self.io.secure_query(query,(self.queue,),cursorclass='Cursor')]
+
+  def lease(self):
+    """ Leases the next batch of pending or expired IDs """
+    # Expired IDs whose load was started on every attempt likely crash the loader
+    query  = "UPDATE LoadQueue SET status='failed' "
+    query += "WHERE queue=%s AND status='leased' AND lease_expires<NOW() AND attempts>=%s"
+    self.io.secure_command(query,(self.queue,self.max_attempts))
+    query  = "UPDATE LoadQueue SET status='leased',worker=%s,"
+    query += "lease_expires=NOW()+INTERVAL %s SECOND "
+    query += "WHERE queue=%s AND (status='pending' OR "
+    query += "(status='leased' AND lease_expires<NOW() AND attempts<%s)) "
+    query += "ORDER BY lq_id LIMIT %s"
+    self.io.secure_command(query,(self.worker,self.lease_time,self.queue,
+                                  self.max_attempts,self.lease_size))
+    query  = "SELECT eid FROM LoadQueue WHERE queue=%s AND worker=%s "
+    query += "AND status='leased' ORDER BY lq_id"
+    return [r[0] for r in self.io.secure_query(query,(self.queue,self.worker),cursorclass='Cursor')]
+
+  def renew(self,eid,io=None,attempt=False):
+    """ Renews the lease on an ID, counting an attempt if the load is about
+        to start. Returns False if this task no longer holds the lease. """
+    io = io if io else self.io
+    query  = "UPDATE LoadQueue SET lease_expires=NOW()+INTERVAL %s SECOND"
+    query += ",attempts=attempts+1 " if attempt else " "
+    query += "WHERE queue=%s AND eid=%s AND worker=%s AND status='leased' "
+    query += "AND lease_expires>=NOW()"
+    io.secure_command(query,(self.lease_time,self.queue,eid,self.worker))
+    # Unchanged rows are not counted by UPDATE, so check ownership directly
+    query  = "SELECT COUNT(*) FROM LoadQueue WHERE queue=%s AND eid=%s "
+    query += "AND worker=%s AND status='leased' AND lease_expires>=NOW()"
+    return bool([r[0] for r in io.secure_query(query,(self.queue,eid,self.worker),cursorclass='Cursor')][0])
+
+  def renew_all(self,io=None):
+    """ Renews the leases on every unexpired ID held by this task """
+    io = io if io else self.io
+    query  = "UPDATE LoadQueue SET lease_expires=NOW()+INTERVAL %s SECOND "
+    query += "WHERE queue=%s AND worker=%s AND status='leased' AND lease_expires>=NOW()"
+    return io.secure_command(query,(self.lease_time,self.queue,self.worker))
+
+  def complete(self,eid):
+    """ Marks an ID as done and renews the lease on the rest of the batch """
+    query  = "UPDATE LoadQueue SET status='done' "
+    query += "WHERE queue=%s AND eid=%s AND worker=%s AND status='leased'"
+    self.io.secure_command(query,(self.queue,eid,self.worker))
+    self.renew_all()
+
+# Main check
+if __name__== "__main__":
+  sys.stderr.write("Class definition. Should not be called from command line.")
+  sys.exit(1)
@@ -15,10 +15,13 @@
 #=============================================================================#
 
 # See main check for cmd line parsing
-import sys,os,csv,copy,time,random,tempfile
+import sys,os,csv,copy,time,random,tempfile,gzip
+import cStringIO
 import subprocess as sp
 import numpy as np
 from Bio.PDB.Structure import Structure
+from Bio.PDB.Model import Model
+from Bio.PDB.Residue import Residue
 from Bio.PDB import Superimposer
 from Bio.PDB.PDBIO import PDBIO
 from Bio.PDB.PDBParser import PDBParser
@@ -47,6 +50,114 @@ def unwrap_self_mutate(arg,**kwargs):
 def unwrap_self_relax(arg,**kwargs):
   return PDBMapStructure.relax(*arg,**kwargs)
 
+class PDBMapResidueTable(object):
+  """ Struct-of-arrays storage for the per-residue PDBMap annotations of
+      one structure. Residues bound to the table become PDBMapResidue
+      views, which read and write their row instead of instance attributes.
+      Missing floats are NaN, missing strings are empty. """
+  FIELDS = [('biounit','i4'),('rescode','S1'),('seqid','i4'),('icode','S1'),
+            ('ss','S1'),('rsa','f8'),('phi','f8'),('psi','f8'),('tco','f8'),
+            ('k','f8'),('a','f8')]
+
+  def __init__(self,n=0):
+    self.coord = np.zeros((n,3),dtype='f4')
+    self.cols  = {}
+    for name,dtype in self.FIELDS:
+      self.cols[name] = np.zeros(n,dtype=dtype)
+      if dtype[0] == 'f':
+        self.cols[name][:] = np.nan
+    self.conflict = {} # Sparse, keyed on row
+
+  def __len__(self):
+    return len(self.coord)
+
+  def bind(self,r,row):
+    """ Converts a Bio.PDB Residue into a view of this row. Annotations
+        already assigned to the residue are moved into the table. """
+    if isinstance(r,PDBMapResidue):
+      # Carry over the row from the residue's previous table
+      old,orow = r._table,r._row
+      self.coord[row] = old.coord[orow]
+      for name,dtype in self.FIELDS:
+        self.cols[name][row] = old.cols[name][orow]
+      if orow in old.conflict:
+        self.conflict[row] = old.conflict[orow]
+    attrs = dict((f,r.__dict__.pop(f)) for f in PDBMapResidue._fields if f in r.__dict__)
+    r.__class__ = PDBMapResidue
+    r._table,r._row = self,row
+    for f,v in attrs.iteritems():
+      setattr(r,f,v)
+    return r
+
+  def merge(self,others):
+    """ Appends the rows of other tables, given as [(table,residues),...],
+        and rebinds their residues. Each column is concatenated once. """
+    if not others: return
+    offsets,n = [],len(self)
+    for t,resis in others:
+      offsets.append(n)
+      n += len(t)
+    self.coord = np.concatenate([self.coord]+[t.coord for t,resis in others])
+    for name,dtype in self.FIELDS:
+      self.cols[name] = np.concatenate([self.cols[name]]+[t.cols[name] for t,resis in others])
+    for (other,residues),offset in zip(others,offsets):
+      for row,v in other.conflict.iteritems():
+        self.conflict[row+offset] = v
+      for r in residues:
+        if isinstance(r,PDBMapResidue) and r._table is other:
+          r._table,r._row = self,r._row+offset
+
+def _column(name,dtype):
+  """ Property reading and writing one table column """
+  if dtype[0] == 'f':
+    def fget(self):
+      v = self._table.cols[name][self._row]
+      return None if np.isnan(v) else float(v)
+    def fset(self,v):
+      self._table.cols[name][self._row] = np.nan if v is None else v
+  elif dtype[0] == 'S':
+    def fget(self):
+      v = self._table.cols[name][self._row]
+      return v if v else None
+    def fset(self,v):
+      self._table.cols[name][self._row] = v if v else ''
+  else:
+    def fget(self):
+      return int(self._table.cols[name][self._row])
+    def fset(self,v):
+      self._table.cols[name][self._row] = v
+  return property(fget,fset)
+
+class PDBMapResidue(Residue):
+  """ Bio.PDB Residue whose PDBMap annotations are stored in the
+      PDBMapResidueTable of its structure. Bio.PDB entities always have an
+      instance __dict__; a view adds only its table and row to it. """
+  _fields = [f for f,dtype in PDBMapResidueTable.FIELDS]+['coord','x','y','z','conflict']
+
+  def _get_coord(self):
+    return self._table.coord[self._row]
+  def _set_coord(self,v):
+    self._table.coord[self._row] = v
+  coord = property(_get_coord,_set_coord)
+  x = property(lambda self: self._table.coord[self._row,0],
+               lambda self,v: self._table.coord.__setitem__((self._row,0),v))
+  y = property(lambda self: self._table.coord[self._row,1],
+               lambda self,v: self._table.coord.__setitem__((self._row,1),v))
+  z = property(lambda self: self._table.coord[self._row,2],
+               lambda self,v: self._table.coord.__setitem__((self._row,2),v))
+
+  def _get_conflict(self):
+    return self._table.conflict.get(self._row,None)
+  def _set_conflict(self,v):
+    if v is None:
+      self._table.conflict.pop(self._row,None)
+    else:
+      self._table.conflict[self._row] = v
+  conflict = property(_get_conflict,_set_conflict)
+
+for _name,_dtype in PDBMapResidueTable.FIELDS:
+  setattr(PDBMapResidue,_name,_column(_name,_dtype))
+
 class PDBMapStructure(Structure):
 
   def __init__(self,s,quality=-1,pdb2pose={},refseq=None,alignment={}):
@@ -59,6 +170,7 @@ class PDBMapStructure(Structure):
       self.quality     = quality
       self.transcripts = []
       self.alignments  = []
+      self.restable    = getattr(s,'restable',None)
       self._pdb2pose   = pdb2pose
       if not self._pdb2pose:
         for m in s:
@@ -167,11 +279,54 @@ class PDBMapStructure(Structure):
       self.transcripts.append(c.transcript)
       self.alignments.append(c.alignment)
 
+  def atomic(self):
+    """ Returns the structure with atoms. Structures read by
+        PDBMapParser.read_structure hold no atoms; their source files are
+        parsed with Bio.PDB and reduced to the residues retained here.
+        Biological assembly models are taken from their own file, or
+        generated from the asymmetric unit by their BIOMT operator. """
+    if 'source' not in self.structure.__dict__:
+      return self.structure
+    parsed = {}
+    def parse(fname):
+      if fname not in parsed:
+        fin = gzip.open(fname,'rb') if fname.split('.')[-1] == 'gz' else open(fname,'rb')
+        p = PDBParser()
+        filterwarnings('ignore',category=PDBConstructionWarning)
+        parsed[fname] = p.get_structure(self.id,cStringIO.StringIO(fin.read()))
+        resetwarnings()
+        fin.close()
+      return parsed[fname]
+    s = Structure(self.id)
+    s.header = self.structure.__dict__.get('header',None)
+    for serial,m in enumerate(self.structure):
+      if 'transform' in m.__dict__:
+        src = parse(self.structure.source)[0]
+      else:
+        src = parse(m.__dict__.get('source',self.structure.source))
+        src = src[m.__dict__.get('source_id',m.id)]
+      am = Model(m.id,serial+1)
+      for c in m:
+        if c.id not in src:
+          continue
+        # Copy the chain without its parent model
+        ac = copy.deepcopy(src[c.id],{id(src):None})
+        for r in list(ac):
+          if r.id not in c:
+            ac.detach_child(r.id)
+        if 'transform' in m.__dict__:
+          rot,trans = m.transform
+          for a in ac.get_atoms():
+            a.set_coord((np.dot(rot,a.coord)+trans).astype(a.coord.dtype))
+        am.add(ac)
+      s.add(am)
+    return s
+
   def pose(self):
     """ Loads the PDBMapStructure as a Rosetta::Pose object """
     import_rosetta()
     io = PDBIO()
-    io.set_structure(self.structure)
+    io.set_structure(self.atomic())
     with tempfile.NamedTemporaryFile('wrb',suffix='.pdb',delete=False) as tf:
       io.save(tf.name)
     pose = rosetta.Pose()
@@ -313,7 +468,7 @@ class PDBMapStructure(Structure):
     p  = PDBParser()
     io = PDBIO()
     with tempfile.NamedTemporaryFile('wrb',suffix='.pdb',delete=False) as tf:
-      io.set_structure(self.structure)
+      io.set_structure(self.atomic())
       io.save(tf.name)
     cmd  = ['lib/clean_pdb.py',tf.name,'ignorechain','nopdbout']
     print "\n%s"%' '.join(cmd)
@@ -442,7 +597,7 @@ class PDBMapStructure(Structure):
       structfile = "temp/%d.pdb"%multidigit_rand(10)
       seqfile.write(altseq)
       scwrlfile = structfile+".scwrl"
-      io.set_structure(self.structure)
+      io.set_structure(self.atomic())
       io.save(structfile)
     cmd = ["scwrl","-0","-i",structfile,'-s',seqfname,'-o',scwrlfile]
     print "\n%s"%' '.join(cmd)
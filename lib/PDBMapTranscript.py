@@ -13,16 +13,30 @@
 #=============================================================================#
 
 # See main check for cmd line parsing
-import sys,os,csv,commands
+import sys,os,csv,commands,sqlite3,zlib,gzip
+from collections import OrderedDict
 from PDBMapProtein import PDBMapProtein
 
 import logging
 
 class PDBMapTranscript():
 	
-  # Transcript query cache, keyed on transcript IDs
-  trans_cache = {}
-  CACHE_ACCESS_MIN = 25
+  # Transcript query cache, keyed on transcript IDs, in LRU order.
+  # Values are (transcript,nbytes). Bounded by entries and estimated bytes.
+  trans_cache = OrderedDict()
+  CACHE_MAX_ENTRIES = 1000
+  CACHE_MAX_BYTES   = 256*1024*1024
+  RESIDUE_BYTES     = 400 # estimated size of one sequence entry
+  cache_bytes = 0
+  cache_stats = {'hits':0,'misses':0,'evictions':0}
+  # Persistent transcript store (SQLite), keyed on transcript ID and
+  # Ensembl release. Holds the output of successful transcript_to_genomic.pl
+  # queries, so known transcripts never return to Ensembl; failed queries
+  # are not stored and are retried.
+  store_fname   = None
+  store_release = None
+  _store_con    = None
+  _store_pid    = None
 
   def __init__(self,transcript,protein,gene,sequence):
     # Define transcript, gene, and sequence
@@ -33,18 +47,236 @@ class PDBMapTranscript():
     # Sequence | value: (rescode,chr,start,end,strand)
     self.sequence   = sequence
 
+  @classmethod
+  def set_cache_size(cls,max_entries=None,max_bytes=None):
+    """ Sets the transcript cache bounds, evicting entries as needed """
+    if max_entries is not None:
+      PDBMapTranscript.CACHE_MAX_ENTRIES = int(max_entries)
+    if max_bytes is not None:
+      PDBMapTranscript.CACHE_MAX_BYTES = int(max_bytes)
+    PDBMapTranscript._evict()
+
   @classmethod
   def cache_transcript(cls,transid,transcript):
     """ Caches a transcript result from a transid query """
-    # Cache the transid->transcript query
-    PDBMapTranscript.trans_cache[transid] = (transcript,0)
-    # Update access counts
-    for tid,(tobj,count) in PDBMapTranscript.trans_cache.iteritems():
-      PDBMapTranscript.trans_cache[tid] = (tobj,count+1)
-    # Remove infrequently accessed entries
-    PDBMapTranscript.trans_cache = dict([(x,(y,z)) for x,(y,z) in \
-                PDBMapTranscript.trans_cache.iteritems() \
-                if z < PDBMapTranscript.CACHE_ACCESS_MIN])
+    cache = PDBMapTranscript.trans_cache
+    if transid in cache:
+      PDBMapTranscript.cache_bytes -= cache.pop(transid)[1]
+    nbytes = 0
+    if transcript:
+      nbytes = len(transcript.sequence)*PDBMapTranscript.RESIDUE_BYTES
+    # Most recently used entries are last
+    cache[transid] = (transcript,nbytes)
+    PDBMapTranscript.cache_bytes += nbytes
+    PDBMapTranscript._evict()
+
+  @classmethod
+  def _evict(cls):
+    """ Removes least recently used entries until within bounds """
+    cache = PDBMapTranscript.trans_cache
+    while cache and (len(cache) > PDBMapTranscript.CACHE_MAX_ENTRIES or \
+        PDBMapTranscript.cache_bytes > PDBMapTranscript.CACHE_MAX_BYTES):
+      tid,(tobj,nbytes) = cache.popitem(last=False)
+      PDBMapTranscript.cache_bytes -= nbytes
+      PDBMapTranscript.cache_stats['evictions'] += 1
+
+  @classmethod
+  def cache_summary(cls):
+    """ Returns a one-line summary of transcript cache usage """
+    stats = PDBMapTranscript.cache_stats
+    return "%d hits, %d misses, %d evictions, %d entries (%.1f MB)"%(
+              stats['hits'],stats['misses'],stats['evictions'],
+              len(PDBMapTranscript.trans_cache),PDBMapTranscript.cache_bytes/1048576.)
+
+  @classmethod
+  def use_store(cls,fname,release):
+    """ Enables the persistent transcript store for this Ensembl release """
+    store_dir = os.path.dirname(fname)
+    if store_dir and not os.path.exists(store_dir):
+      os.makedirs(store_dir)
+    PDBMapTranscript.store_fname   = fname
+    PDBMapTranscript.store_release = str(release)
+    PDBMapTranscript._store_con    = None
+
+  @classmethod
+  def _store(cls):
+    """ Returns this process's connection to the transcript store """
+    if not PDBMapTranscript.store_fname:
+      return None
+    if PDBMapTranscript._store_pid != os.getpid() or not PDBMapTranscript._store_con:
+      # SQLite connections must not be shared across forked workers
+      con = sqlite3.connect(PDBMapTranscript.store_fname,timeout=300)
+      con.text_factory = str
+      con.execute("""CREATE TABLE IF NOT EXISTS Transcript (
+                     transcript TEXT NOT NULL,
+                     release TEXT NOT NULL,
+                     status INTEGER NOT NULL,
+                     output BLOB,
+                     PRIMARY KEY(transcript,release))""")
+      con.commit()
+      PDBMapTranscript._store_con = con
+      PDBMapTranscript._store_pid = os.getpid()
+    return PDBMapTranscript._store_con
+
+  @classmethod
+  def store_get(cls,transid):
+    """ Returns the stored (status,output) for a transcript, or None """
+    con = PDBMapTranscript._store()
+    if not con: return None
+    # Failed queries are never reused
+    query = "SELECT status,output FROM Transcript WHERE transcript=? AND release=? AND status=0"
+    row = con.execute(query,(transid,PDBMapTranscript.store_release)).fetchone()
+    if not row: return None
+    return row[0],zlib.decompress(row[1])
+
+  @classmethod
+  def store_put(cls,rows):
+    """ Stores a list of (transid,status,output) query results. Failed
+        queries may be transient (Perl, Ensembl, network) and are not
+        stored, so they are retried. Returns the number stored. """
+    con = PDBMapTranscript._store()
+    if not con: return 0
+    release = PDBMapTranscript.store_release
+    rows  = [(t,release,s,sqlite3.Binary(zlib.compress(o))) for t,s,o in rows if s == 0]
+    query = "INSERT OR REPLACE INTO Transcript VALUES (?,?,?,?)"
+    con.executemany(query,rows)
+    con.commit()
+    return len(rows)
+
+  @classmethod
+  def stored_transcripts(cls):
+    """ Returns the set of transcript IDs stored for this release """
+    con = PDBMapTranscript._store()
+    if not con: return set()
+    query = "SELECT transcript FROM Transcript WHERE release=? AND status=0"
+    return set(r[0] for r in con.execute(query,(PDBMapTranscript.store_release,)))
+
+  @classmethod
+  def query_ensembl(cls,transid):
+    """ Queries the Ensembl API for the transcript. Returns (status,output). """
+    cmd = "perl lib/transcript_to_genomic.pl %s"%transid
+    status, output = commands.getstatusoutput(cmd)
+    return int(status > 0),output
+
+  @classmethod
+  def populate_store(cls,transids,workers=1,buffer_size=100,gtf=None,pep=None):
+    """ Queries and stores all transcripts missing from the store. If an
+        Ensembl GTF and peptide FASTA are provided, transcripts are mapped
+        from the local files rather than queried from Ensembl. """
+    if not PDBMapTranscript._store():
+      raise Exception("PDBMapTranscript.use_store must be called before populating the store.")
+    known    = PDBMapTranscript.stored_transcripts()
+    transids = sorted(set(t for t in transids if t not in known))
+    msg = "  WARNING (PDBMapTranscript) Querying %d transcripts missing from %s.\n"
+    sys.stderr.write(msg%(len(transids),PDBMapTranscript.store_fname))
+    if gtf and pep:
+      workers = 1 # single pass over the local files
+      results = PDBMapTranscript.map_from_files(gtf,pep,transids)
+    elif workers > 1:
+      from multiprocessing import Pool
+      pool = Pool(processes=workers)
+      results = pool.imap_unordered(_query_ensembl,transids)
+    else:
+      results = (_query_ensembl(t) for t in transids)
+    rows,nrows = [],0
+    for row in results:
+      rows.append(row)
+      if len(rows) >= buffer_size:
+        nrows += PDBMapTranscript.store_put(rows)
+        rows = []
+    nrows += PDBMapTranscript.store_put(rows)
+    if workers > 1:
+      pool.close(); pool.join()
+    return nrows
+
+  @classmethod
+  def _read_pep(cls,pep_fname):
+    """ Reads an Ensembl peptide FASTA. Returns a dictionary of
+        transcript -> (protein,gene,biotype,sequence) """
+    peps = {}
+    def add(header,seq):
+      if not header: return
+      fields = header.split()
+      info   = dict(f.split(':',1) for f in fields[1:] if ':' in f)
+      transid = info.get('transcript','').split('.')[0]
+      biotype = info.get('transcript_biotype',info.get('biotype','protein_coding'))
+      peps[transid] = (fields[0].split('.')[0],info.get('gene','').split('.')[0],
+                        biotype,''.join(seq))
+    with _open(pep_fname) as fin:
+      header,seq = None,[]
+      for line in fin:
+        if line.startswith('>'):
+          add(header,seq)
+          header,seq = line[1:].strip(),[]
+        else:
+          seq.append(line.strip())
+      add(header,seq)
+    return peps
+
+  @classmethod
+  def _read_gtf(cls,gtf_fname,transids=None):
+    """ Reads CDS features from an Ensembl GTF. Returns a dictionary of
+        transcript -> (chr,strand,[(start,end,frame),...]) """
+    cds = {}
+    with _open(gtf_fname) as fin:
+      for line in fin:
+        if line.startswith('#'): continue
+        row = line.rstrip('\n').split('\t')
+        if len(row) < 9 or row[2] != "CDS": continue
+        attr = row[8]
+        i = attr.find('transcript_id "')
+        if i < 0: continue
+        transid = attr[i+15:attr.index('"',i+15)].split('.')[0]
+        if transids is not None and transid not in transids: continue
+        strand = 1 if row[6] == '+' else -1
+        frame  = int(row[7]) if row[7] != '.' else 0
+        if transid not in cds:
+          cds[transid] = (row[0],strand,[])
+        cds[transid][2].append((int(row[3]),int(row[4]),frame))
+    return cds
+
+  @classmethod
+  def map_from_files(cls,gtf_fname,pep_fname,transids=None):
+    """ Generator: maps transcripts to the genome from a local Ensembl GTF
+        and peptide FASTA. Yields (transid,status,output) with output in
+        the format of transcript_to_genomic.pl """
+    if transids is not None:
+      transids = set(transids)
+    peps = PDBMapTranscript._read_pep(pep_fname)
+    cds  = PDBMapTranscript._read_gtf(gtf_fname,transids)
+    for transid in (sorted(transids) if transids is not None else sorted(cds)):
+      if transid not in cds or transid not in peps:
+        yield transid,1,"Not a valid human transcript ID: %s"%transid
+        continue
+      protein,gene,biotype,peptide = peps[transid]
+      if biotype != "protein_coding":
+        yield transid,1,"%s is not protein coding."%transid
+        continue
+      chrom,strand,segs = cds[transid]
+      # Order CDS segments 5' to 3' along the transcript
+      segs = sorted(segs,key=lambda s: s[0]*strand)
+      # Incomplete 5' CDS; the first codon is padded as in Ensembl
+      pad  = (3-segs[0][2])%3
+      chrom = chrom if chrom.startswith('chr') else "chr%s"%chrom
+      lines,k,seg_off = [],0,0 # current segment and its CDS offset
+      for i,aa in enumerate(peptide):
+        a,b = max(i*3-pad,0),(i+1)*3-pad
+        if b <= 0: continue
+        # Advance to the segment containing CDS offset a
+        while k < len(segs) and a >= seg_off+segs[k][1]-segs[k][0]+1:
+          seg_off += segs[k][1]-segs[k][0]+1
+          k += 1
+        if k >= len(segs): break
+        start,end,_ = segs[k]
+        # Report the first genomic piece of the codon, as pep2genomic
+        b = min(b,seg_off+end-start+1)
+        if strand > 0:
+          q_start,q_end = start+a-seg_off,start+b-1-seg_off
+        else:
+          q_start,q_end = end-(b-1-seg_off),end-(a-seg_off)
+        lines.append("%s\t%s\t%s\t%d\t%s\t%d\t%d\t%s\t%d"%(transid,protein,gene,
+                      i+1,aa,q_start,q_end+1,chrom,strand))
+      yield transid,0,'\n'.join(lines)
 
   @classmethod
   def query_from_unp(cls,unpid):
@@ -74,12 +306,23 @@ class PDBMapTranscript():
   def query_from_trans(cls,transid):
     """ Use Ensembl Transcript ID to load transcript information """
     # Check for cached transcript query result
-    if transid in PDBMapTranscript.trans_cache:
-      trans = PDBMapTranscript.trans_cache[transid][0] # exclude the count
-      return trans
-    # Query the Ensembl API for the transcript
+    cache = PDBMapTranscript.trans_cache
+    if transid in cache:
+      # Move to the most recently used position
+      entry = cache.pop(transid)
+      cache[transid] = entry
+      PDBMapTranscript.cache_stats['hits'] += 1
+      return entry[0] # exclude the size
+    PDBMapTranscript.cache_stats['misses'] += 1
     cmd = "perl lib/transcript_to_genomic.pl %s"%transid
-    status, output = commands.getstatusoutput(cmd)
+    # Check the persistent transcript store
+    stored = PDBMapTranscript.store_get(transid)
+    if stored:
+      status,output = stored
+    else:
+      # Query the Ensembl API for the transcript
+      status,output = PDBMapTranscript.query_ensembl(transid)
+      PDBMapTranscript.store_put([(transid,status,output)])
     if status > 0:
       # msg = "   WARNING (transcript_to_genomic.pl) %s: %s\n"%(transid,output)
       # sys.stderr.write(msg)
@@ -113,6 +356,15 @@ class PDBMapTranscript():
     PDBMapTranscript.cache_transcript(transid,trans)
     return trans
  
+def _open(fname):
+  """ Opens a plain or gzipped text file """
+  return gzip.open(fname,'rb') if fname.endswith('.gz') else open(fname,'rb')
+
+def _query_ensembl(transid):
+  """ Pool-compatible wrapper. Returns (transid,status,output). """
+  status,output = PDBMapTranscript.query_ensembl(transid)
+  return transid,status,output
+
 aa_code_map = {"ala" : "A",
         "arg" : "R",
         "asn" : "N",
@@ -9,3 +9,6 @@ from .PDBMapAlignment import PDBMapAlignment
 from .PDBMapData import PDBMapData
 from .PDBMapIntersect import PDBMapIntersect
 from .PDBMapVisualize import PDBMapVisualize
+from .PDBMapQueue import PDBMapQueue
+from .PDBMapJournal import PDBMapJournal
+from .PDBMapColumnStore import PDBMapColumnStore
@@ -0,0 +1,8 @@
+CREATE TABLE IF NOT EXISTS IntersectionMark (
+dlabel VARCHAR(100), # Dataset label ('' for all datasets)
+slabel VARCHAR(100), # Structure label ('' for all structures)
+gc_max BIGINT NOT NULL DEFAULT 0, # Highest GenomicConsequence.gc_id intersected
+al_max BIGINT NOT NULL DEFAULT 0, # Highest Alignment.al_id intersected
+updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+PRIMARY KEY(dlabel,slabel)
+)
\ No newline at end of file
@@ -0,0 +1,13 @@
+CREATE TABLE IF NOT EXISTS LoadQueue (
+queue VARCHAR(100), # Queue name, shared by all cooperating tasks
+eid VARCHAR(100), # Entity ID to load (PDB ID, UniProt AC, ...)
+status VARCHAR(10) NOT NULL DEFAULT 'pending', # pending, leased, done, or failed
+worker VARCHAR(100), # Host and process currently holding the lease
+lease_expires DATETIME, # Leases past this time are returned to the queue
+attempts INT NOT NULL DEFAULT 0, # Number of times a load of this entity was started
+lq_id BIGINT NOT NULL AUTO_INCREMENT, # Unique, direct-reference key
+PRIMARY KEY(queue,eid),
+KEY(lq_id),
+KEY(queue,status,lease_expires),
+KEY(queue,worker)
+)
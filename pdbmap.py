@@ -22,7 +22,7 @@ import argparse,ConfigParser
 import traceback
 import sys,os,csv,time,pdb,glob,gzip,shutil
 import subprocess as sp
-from multiprocessing import cpu_count
+from multiprocessing import cpu_count,Pool
 import numpy as np
 from Bio.PDB.PDBIO import PDBIO
 from Bio.PDB.PDBParser import PDBParser
@@ -31,6 +31,7 @@ from Bio.PDB.PDBExceptions import PDBConstructionWarning
 from lib import PDBMapIO,PDBMapParser,PDBMapStructure,PDBMapProtein
 from lib import PDBMapAlignment,PDBMapData,PDBMapTranscript
 from lib import PDBMapIntersect,PDBMapModel, PDBMapSwiss
+from lib import PDBMapQueue,PDBMapJournal
 from lib.PDBMapVisualize import PDBMapVisualize
 from lib import amino_acids
 import logging
@@ -49,6 +50,8 @@ class PDBMap():
     self.modbase = False
     self.pdb     = False
     self.modbase = False
+    self._ios    = {} # PDBMapIO objects, keyed on (process,label)
+    self.last_status = ("","") # (status,reason) of the most recent load
     # Initialize
     if idmapping:
       PDBMapProtein.load_idmapping(idmapping)
@@ -76,43 +79,58 @@ class PDBMap():
     if probe:
       self.probe = probe
 
+  def get_io(self,label):
+    """ Returns the PDBMapIO for this label, one per process """
+    key = (os.getpid(),label)
+    if key not in self._ios:
+      self._ios[key] = PDBMapIO(args.dbhost,args.dbuser,
+                                  args.dbpass,args.dbname,slabel=label)
+    return self._ios[key]
+
   def load_unp(self,unp,label=None,use_pdb=True,use_modbase=True,update=False):
     """ Loads all known structures associated with UniProt ID """
+    pdbids,models = [],[]
+    nvalid,nerror = 0,0
     if self.pdb and use_pdb:
       pdb_label = label if label else 'pdb'
       pdb_label = "%s_update"%pdb_label if update else pdb_label
-      io = PDBMapIO(args.dbhost,args.dbuser,
-                          args.dbpass,args.dbname,slabel=pdb_label)
+      io = self.get_io(pdb_label)
       pdbids = list(set(PDBMapProtein.unp2pdb(unp)))
       for pdbid in pdbids:
         print " # Processing (%s) PDB %s # "%(pdb_label,pdbid)
-        self.load_pdb(pdbid,label=pdb_label,io=io)
+        rc = self.load_pdb(pdbid,label=pdb_label,io=io)
+        nvalid,nerror = nvalid+int(not rc),nerror+int(bool(rc))
         sys.stdout.flush() # Force stdout flush after each PDB
     if self.modbase and use_modbase:
       mod_label = label if label else 'modbase'
       mod_label = "%s_update"%mod_label if update else mod_label
-      io = PDBMapIO(args.dbhost,args.dbuser,
-                          args.dbpass,args.dbname,slabel=mod_label)
+      io = self.get_io(mod_label)
       modelids = PDBMapModel.unp2modbase(unp)
       models   = [PDBMapModel.get_info(modelid) for modelid in modelids]
       for model in models:
         print " # (%s) Processing ModBase %s #"%(mod_label,model['modelid'])
-        self.load_model(model,label=mod_label,io=io)
+        rc = self.load_model(model,label=mod_label,io=io)
+        nvalid,nerror = nvalid+int(not rc),nerror+int(bool(rc))
         sys.stdout.flush() # Force stdout flush after each model
     if not pdbids and not models:
       msg = "  WARNING (PDBMap) No PDB structures or Modbase models found for %s\n"%unp
       sys.stderr.write(msg)
+      self.last_status = ("SKIP","no structures or models")
+    elif nerror:
+      self.last_status = ("ERROR","%d of %d structures failed"%(nerror,nvalid+nerror))
+    else:
+      self.last_status = ("VALID","%d structures"%nvalid)
+    return nvalid,nerror
 
   def load_pdb(self,pdbid,pdb_fname=None,label="",io=None,update=False):
     """ Loads a given PDB into the PDBMap database """
     if not io:
-      # Create a PDBMapIO object
-      io = PDBMapIO(args.dbhost,args.dbuser,
-                            args.dbpass,args.dbname,slabel=label)
+      io = self.get_io(label)
     # Check if PDB is already in the database
     if io.structure_in_db(pdbid,label):
       if not update: # silence if updating
         print "  VALID (PDBMap) %s already in database."%pdbid
+        self.last_status = ("SKIP","already in database")
         return 0
     # Load the PDB structure
     if not pdb_fname:
@@ -121,6 +139,7 @@ class PDBMap():
       if not os.path.exists(pdb_fname):
         msg = "  ERROR (PDBMap) Cannot fetch %s. Not in PDB mirror.\n"%pdbid
         sys.stderr.write(msg)
+        self.last_status = ("ERROR","not in PDB mirror")
         return 1
     # Locate all biological assemblies
     biounit_fnames = glob.glob("%s/biounit/coordinates/all/%s.pdb*.gz"%(self.pdb_dir,pdbid.lower()))
@@ -132,16 +151,16 @@ class PDBMap():
     except Exception as e:
       msg = "  ERROR (PDBMap) %s: %s\n\n"%(pdbid,str(e))
       sys.stderr.write(msg)
+      self.last_status = ("ERROR",str(e))
       return 1
     msg = "  VALID (PDBMap) %s complete.\n"%pdbid
     sys.stderr.write(msg)
+    self.last_status = ("VALID","")
     return 0
 
   def load_swiss_to_MySQL(self,modelid,label="",io=None):
     if not io:
-      # Create a PDBMapIO object
-      io = PDBMapIO(args.dbhost,args.dbuser,
-                            args.dbpass,args.dbname,slabel=label)
+      io = self.get_io(label)
 
     # Load the dictionary of information about the modelid
     model_summary = PDBMapSwiss.get_info(modelid)
@@ -162,9 +181,11 @@ class PDBMap():
 
     try:
       # import pdb; pdb.set_trace()
-      s = PDBMapParser.getBiopythonStructureOrFail(modelid,model_fname)
+      data = PDBMapParser.read_pdb_file(model_fname)
+      s = PDBMapParser.read_structure(modelid,model_fname,data)
       m = PDBMapSwiss(s,model_summary)
-      s = PDBMapParser.process_structure_dssp_unp2hgnc(m,model_summary,model_fname,m.unp)
+      s = PDBMapParser.process_structure_dssp_unp2hgnc(m,model_summary,model_fname,m.unp,
+                                                       lines=data.splitlines(True))
 
       io.set_structure(m)
       io.upload_swiss()
@@ -182,13 +203,11 @@ class PDBMap():
 
 
 
-  def load_model(self,model_summary,label="",io=None):
+  def load_model(self,model_summary,label="",io=None,update=False):
     """ Loads a given ModBase model into the PDBMap database """
     
     if not io:
-      # Create a PDBMapIO object
-      io = PDBMapIO(args.dbhost,args.dbuser,
-                            args.dbpass,args.dbname,slabel=label)
+      io = self.get_io(label)
 
     # Check if model is already in the database
     modelid = model_summary['modelid'] # extract ModBase model ID
@@ -276,10 +295,10 @@ class PDBMap():
       msg = "  ERROR (PDBMap) Unsupported file type: %s"%ext
       raise Exception(msg)
     # Pass the relevant generator to be uploaded
-    nrows = io.upload_genomic_data(generator,dname)
+    nrows = io.upload_genomic_data(generator,dname,args.buffer_size)
     return(nrows)
   
-  def intersect_data(self,dname,slabel=None,dtype="Genomic",quick=False):
+  def intersect_data(self,dname,slabel=None,dtype="Genomic",quick=False,full=False):
     """ Intersects a loaded dataset with the PDBMap structural domain """
     io = PDBMapIO(args.dbhost,args.dbuser,args.dbpass,args.dbname,dlabel=dname,slabel=slabel)
     i = PDBMapIntersect(io)
@@ -287,7 +306,9 @@ class PDBMap():
     if quick:
     	nrows = i.quick_intersect(dname,slabel,dtype)
     else:
-    	nrows = i.intersect(dname,slabel,dtype,args.buffer_size)
+    	nrows = i.intersect(dname,slabel,dtype,args.intersect_buffer,args.workers,
+                          incremental=not full,load_infile=args.load_infile,
+                          defer_keys=args.defer_keys)
     return(nrows) # Return the number of intersections
 
   def visualize(self,entity,biounits=[],struct_label='pdb',
@@ -406,6 +427,107 @@ class PDBMap():
       get_modbase   = "cd %s; ./get_modbase_2013.sh"%(script_path)
       os.system(get_modbase)
 
+def journal_label(label,update=False):
+  """ Returns the journal label of a run. Update runs are journaled
+      apart from normal runs, so that neither resumes from the other. """
+  return "%s%s"%(label or "","_update" if update else "")
+
+def load_job(job):
+  """ Loads one PDB or UniProt ID. Returns (valid,error) counts.
+      The outcome is recorded in the status journal, if any. """
+  cmd,eid,fname,label,update,i,n = job
+  t0 = time.time()
+  pdbmap.last_status = ("","")
+  try:
+    if cmd == "load_pdb":
+      print "## Processing (%s) %s (%d/%d) ##"%(label,eid,i,n)
+      rc = pdbmap.load_pdb(eid,fname,label=label,update=update)
+      counts = int(not rc),int(bool(rc))
+    else:
+      print "\n## Processing (%s) %s (%d/%d) ##"%(label,eid,i,n)
+      counts = pdbmap.load_unp(eid,label=label,update=update)
+  except Exception as e:
+    msg = "  ERROR (PDBMap) %s: %s\n"%(eid,str(e))
+    sys.stderr.write(msg)
+    pdbmap.last_status = ("ERROR",str(e))
+    counts = 0,1
+  finally:
+    sys.stdout.flush()
+  if journal:
+    status,reason = pdbmap.last_status
+    if not status:
+      status = "ERROR" if counts[1] else "VALID"
+    journal.record(cmd,journal_label(label,update),eid,status,time.time()-t0,reason)
+  if i and i % 100 == 0:
+    logging.getLogger(__name__).info("Transcript cache: %s"%PDBMapTranscript.cache_summary())
+  return counts
+
+def run_jobs(jobs,workers=1):
+  """ Runs load jobs serially or across a pool of worker processes.
+      Each worker process opens its own PDBMapIO connections. """
+  nvalid,nerror = 0,0
+  if workers > 1:
+    msg = "WARNING (PDBMap) Distributing %d jobs across %d workers.\n"%(len(jobs),workers)
+    sys.stderr.write(msg)
+    pool = Pool(processes=workers)
+    try:
+      for valid,error in pool.imap_unordered(load_job,jobs):
+        nvalid,nerror = nvalid+valid,nerror+error
+      pool.close()
+    except:
+      pool.terminate()
+      raise
+    finally:
+      pool.join()
+  else:
+    for job in jobs:
+      valid,error = load_job(job)
+      nvalid,nerror = nvalid+valid,nerror+error
+  msg = "WARNING (PDBMap) Load complete: %d VALID, %d ERROR\n"%(nvalid,nerror)
+  sys.stderr.write(msg)
+  return nvalid,nerror
+
+def queue_job(qjob):
+  """ Loads IDs leased from a shared queue until it is exhausted """
+  qname,cmd,label,update = qjob
+  queue = PDBMapQueue(pdbmap.get_io(label),qname)
+  n = queue.remaining()
+  nvalid,nerror = 0,0
+  for i,eid in enumerate(queue):
+    valid,error = load_job((cmd,eid,None,label,update,i,n))
+    nvalid,nerror = nvalid+valid,nerror+error
+  return nvalid,nerror
+
+def run_queue(qname,cmd,eids,label,update=False,workers=1):
+  """ Populates the shared queue if needed, then loads from it with one
+      or more worker processes. Many tasks may share the same queue. """
+  queue = PDBMapQueue(pdbmap.get_io(label),qname)
+  if not queue.size():
+    queue.populate(eids)
+  msg = "WARNING (PDBMap) Queue %s: %d of %d IDs remaining.\n"%(qname,queue.remaining(),queue.size())
+  sys.stderr.write(msg)
+  qjobs = [(qname,cmd,label,update)]*workers
+  if workers > 1:
+    pool = Pool(processes=workers)
+    try:
+      counts = pool.map(queue_job,qjobs)
+      pool.close()
+    except:
+      pool.terminate()
+      raise
+    finally:
+      pool.join()
+  else:
+    counts = [queue_job(qjob) for qjob in qjobs]
+  nvalid,nerror = sum(c[0] for c in counts),sum(c[1] for c in counts)
+  msg = "WARNING (PDBMap) Load complete: %d VALID, %d ERROR\n"%(nvalid,nerror)
+  sys.stderr.write(msg)
+  failed = queue.failed()
+  if failed:
+    msg = "WARNING (PDBMap) Queue %s: %d IDs failed on every attempt: %s\n"%(qname,len(failed),','.join(failed))
+    sys.stderr.write(msg)
+  return nvalid,nerror
+
 # Command line usage
 if __name__== "__main__":
 
@@ -460,8 +582,25 @@ __  __  __
     "noupload" : False,
     "buffer_size" : 100,
     "cores"  : 1,
+    "workers" : None,
     "ppart"  : None,
-    "ppidx"  : None
+    "ppidx"  : None,
+    "queue"  : None,
+    "journal" : None,
+    "resume" : False,
+    "retry_failed" : False,
+    "transcript_store" : None,
+    "ensembl_release" : "87",
+    "transcript_cache" : None,
+    "transcript_cache_mb" : None,
+    "ensembl_gtf" : None,
+    "ensembl_pep" : None,
+    "alignment_store" : None,
+    "column_store" : None,
+    "dssp_store" : None,
+    "intersect_buffer" : 5000,
+    "load_infile" : False,
+    "defer_keys" : False
     }
   if args.conf_file:
     config = ConfigParser.SafeConfigParser()
@@ -476,7 +615,7 @@ __  __  __
   parser.add_argument("-v", "--version", action="version", 
               version="PDBMap version 1.8")
   parser.add_argument("cmd",nargs='?', 
-              help="PDBMap subroutine: refresh, load_pdb, load_unp, load_data, intersect, visualize")
+              help="PDBMap subroutine: refresh, load_pdb, load_unp, load_transcripts, load_data, intersect, visualize")
   parser.add_argument("args",nargs=argparse.REMAINDER, 
               help="Arguments to cmd")
   parser.add_argument("--dbhost", 
@@ -529,14 +668,48 @@ __  __  __
               help="Disables VEP consequence prediction. If no CSQ provided, all SNPs uploaded.")
   parser.add_argument("--noupload",action='store_true',
               help="Disables upload of the original data file to a supplementary database. Potential information loss.")
+  parser.add_argument("--transcript_store",
+              help="SQLite file caching transcript-to-genome mappings across runs")
+  parser.add_argument("--ensembl_release",
+              help="Ensembl release of the transcript mappings (default: 87)")
+  parser.add_argument("--alignment_store",
+              help="SQLite file caching chain-to-transcript alignments across runs")
+  parser.add_argument("--dssp_store",
+              help="SQLite file caching parsed DSSP results across runs")
+  parser.add_argument("--column_store",
+              help="Directory of columnar, memory-mapped structure exports")
+  parser.add_argument("--ensembl_gtf",
+              help="Local Ensembl GTF used by load_transcripts in place of the Ensembl API")
+  parser.add_argument("--ensembl_pep",
+              help="Local Ensembl peptide FASTA used with --ensembl_gtf")
+  parser.add_argument("--transcript_cache", type=int,
+              help="Maximum number of transcripts held in memory (default: 1000)")
+  parser.add_argument("--transcript_cache_mb", type=int,
+              help="Maximum estimated size (MB) of transcripts held in memory (default: 256)")
   parser.add_argument("--buffer_size", type=int,
               help="Size of mysql buffer (in rows/records) when applicable")
+  parser.add_argument("--intersect_buffer", type=int,
+              help="Rows per multi-row INSERT when uploading intersections (default: 5000)")
+  parser.add_argument("--load_infile",action='store_true',
+              help="Upload intersections with LOAD DATA LOCAL INFILE through a pipe")
+  parser.add_argument("--defer_keys",action='store_true',
+              help="Drop GenomicIntersection secondary indexes until the intersection completes")
   parser.add_argument("--ppart", type=int,
               help="Used to manage parallel subprocesses. Do not call directly.")
   parser.add_argument("--ppidx", type=int,
               help="Used to manage parallel subprocesses. Do not call directly.")
+  parser.add_argument("--queue",
+              help="Name of a shared work queue for load_pdb/load_unp all. Replaces --ppart/--ppidx.")
+  parser.add_argument("--journal",
+              help="Status journal for load_pdb/load_unp all (default: pdbmap_<cmd>.journal)")
+  parser.add_argument("--resume",action='store_true',
+              help="Skip IDs recorded as complete in the status journal")
+  parser.add_argument("--retry-failed",dest="retry_failed",action='store_true',
+              help="Process only IDs recorded as failed in the status journal")
   parser.add_argument("-j", "--cores", type=int,
               help="Number of available processors")
+  parser.add_argument("--workers", type=int,
+              help="Number of worker processes for load_pdb/load_unp all (default: cores)")
 
   args = parser.parse_args(remaining_argv)
   args.conf_file = conf_file
@@ -544,6 +717,24 @@ __  __  __
   args.create_new_db = bool(args.create_new_db)
   args.force = bool(args.force)
   args.cores = int(args.cores)
+  args.workers = int(args.workers) if args.workers else args.cores
+  args.resume = bool(args.resume)
+  args.load_infile = bool(args.load_infile)
+  args.defer_keys = bool(args.defer_keys)
+  args.intersect_buffer = int(args.intersect_buffer)
+  args.retry_failed = bool(args.retry_failed)
+  journal = None
+  if args.transcript_store:
+    PDBMapTranscript.use_store(args.transcript_store,args.ensembl_release)
+  if args.alignment_store:
+    PDBMapAlignment.use_store(args.alignment_store)
+  if args.dssp_store:
+    PDBMapIO.use_dssp_store(args.dssp_store)
+  if args.column_store:
+    PDBMapIO.column_store_dir = args.column_store
+  if args.transcript_cache or args.transcript_cache_mb:
+    max_bytes = int(args.transcript_cache_mb)*1024*1024 if args.transcript_cache_mb else None
+    PDBMapTranscript.set_cache_size(args.transcript_cache,max_bytes)
 
   if args.create_new_db and not args.force:
     print "You have opted to create a new database: %s."%args.dbname
@@ -595,30 +786,44 @@ __  __  __
       all_pdb_files = [fname%(args.pdb_dir,pdbid.lower()) for pdbid in all_pdb_ids]
       # Remove any PDB files not contained in the local PDB mirror
       all_pdb_files = [f for f in all_pdb_files if os.path.exists(f)]
+      journal = PDBMapJournal(args.journal if args.journal else "pdbmap_load_pdb.journal")
+      if args.resume or args.retry_failed:
+        # Consult the status journal rather than the database
+        pdbids = [os.path.basename(f).split('.')[0][-4:].upper() for f in all_pdb_files]
+        pdbids = set(journal.filter("load_pdb",journal_label(args.slabel,update),pdbids,args.retry_failed))
+        all_pdb_files = [f for f in all_pdb_files if os.path.basename(f).split('.')[0][-4:].upper() in pdbids]
+        msg = "WARNING (PDBMap) %d PDB IDs remain after checking %s.\n"%(len(all_pdb_files),journal.fname)
+        sys.stderr.write(msg)
       msg = "WARNING (PDBMap) Uploading %d Human Swiss-Prot PDB structures.\n"%len(all_pdb_files)
       sys.stderr.write(msg)
       n = len(all_pdb_files)
-      # If this is a parallel command with partition parameters
-      if args.ppart != None and args.ppidx != None:
-        psize = n / args.ppart # floor
-        if (args.ppart-1) == args.ppidx:
-          all_pdb_files = all_pdb_files[args.ppidx*psize:]
-        else:
-          all_pdb_files = all_pdb_files[args.ppidx*psize:(args.ppidx+1)*psize]
-        msg = "WARNING(PDBMap) Subprocess uploading partition %d/%d of PDB\n"%(args.ppidx+1,args.ppart)
-        sys.stderr.write(msg)
-        for i,pdb_file in enumerate(all_pdb_files):
-          pdbid = os.path.basename(pdb_file).split('.')[0][-4:].upper()
-          print "## Processing (%s) %s (%d/%d) ##"%(args.slabel,pdbid,i+(args.ppidx*psize)+1,n)
-          pdbmap.load_pdb(pdbid,pdb_file,label=args.slabel,update=update)
+      # Fetch all previously loaded structures once; skip checks are then local
+      io = PDBMapIO(args.dbhost,args.dbuser,args.dbpass,args.dbname,slabel=args.slabel)
+      # Structures loaded by other workers or tasks are confirmed in MySQL
+      shared = bool(args.queue) or args.workers > 1
+      print "%d (%s) structures already in database."%(io.preload_loaded('Structure',shared=shared),args.slabel)
+      # If this task pulls from a shared work queue
+      if args.queue:
+        pdbids = [os.path.basename(f).split('.')[0][-4:].upper() for f in all_pdb_files]
+        run_queue(args.queue,"load_pdb",pdbids,args.slabel,update,args.workers)
       else:
-        msg = "WARNING(PDBMap) Uploading all %d PDB IDs.\n"%n
-        sys.stderr.write(msg)
-        for i,pdb_file in enumerate(all_pdb_files):
-          pdbid = os.path.basename(pdb_file).split('.')[0][-4:].upper()
-      
-          print "## Processing (pdb) %s (%d/%d) ##"%(pdbid,i,n)
-          pdbmap.load_pdb(pdbid,pdb_file,label=args.slabel,update=update)
+        # If this is a parallel command with partition parameters
+        if args.ppart != None and args.ppidx != None:
+          psize = n / args.ppart # floor
+          if (args.ppart-1) == args.ppidx:
+            all_pdb_files = all_pdb_files[args.ppidx*psize:]
+          else:
+            all_pdb_files = all_pdb_files[args.ppidx*psize:(args.ppidx+1)*psize]
+          msg = "WARNING(PDBMap) Subprocess uploading partition %d/%d of PDB\n"%(args.ppidx+1,args.ppart)
+          sys.stderr.write(msg)
+          offset = args.ppidx*psize+1
+        else:
+          msg = "WARNING(PDBMap) Uploading all %d PDB IDs.\n"%n
+          sys.stderr.write(msg)
+          offset = 0
+        jobs = [("load_pdb",os.path.basename(pdb_file).split('.')[0][-4:].upper(),pdb_file,
+                  args.slabel,update,i+offset,n) for i,pdb_file in enumerate(all_pdb_files)]
+        run_jobs(jobs,args.workers)
     elif len(args.args) == 1:
       # Process one PDB
       pdb_file = args.args[0].strip()
@@ -669,27 +874,45 @@ __  __  __
       all_unp = [unp for unp in PDBMapProtein._unp2enst \
                   if unp in PDBMapProtein.sprot and \
                   PDBMapProtein.unp2species[unp]=="HUMAN"]
+      journal = PDBMapJournal(args.journal if args.journal else "pdbmap_load_unp.journal")
+      if args.resume or args.retry_failed:
+        # Consult the status journal rather than the database
+        all_unp = journal.filter("load_unp",journal_label(args.slabel,update),all_unp,args.retry_failed)
+        msg = "WARNING (PDBMap) %d UniProt IDs remain after checking %s.\n"%(len(all_unp),journal.fname)
+        sys.stderr.write(msg)
       n = len(all_unp)
+      # Fetch all previously loaded structures and models once
+      io = PDBMapIO(args.dbhost,args.dbuser,args.dbpass,args.dbname)
+      suffix = "_update" if update else ""
+      # UniProt IDs share structures and models, so those loaded by other
+      # workers or tasks are confirmed in MySQL
+      shared = bool(args.queue) or args.workers > 1 or args.ppart != None
+      if pdbmap.pdb:
+        io.preload_loaded('Structure',"pdb%s"%suffix,shared=shared)
+      if pdbmap.modbase:
+        io.preload_loaded('Model',"modbase%s"%suffix,shared=shared)
       print "Total Swiss-Prot IDs to process: %d. Beginning..."%n
-      # If this is a parallel command with partition parameters
-      if args.ppart != None and args.ppidx != None:
-        psize = n / args.ppart # floor
-        if (args.ppart-1) == args.ppidx:
-          all_unp = all_unp[args.ppidx*psize:]
-        else:
-          all_unp = all_unp[args.ppidx*psize:(args.ppidx+1)*psize]
-        msg = "WARNING (PDBMap) Subprocess uploading partition %d/%d of Swiss-Prot\n"%(args.ppidx+1,args.ppart)
-        sys.stderr.write(msg)
-        for i,unp in enumerate(all_unp):
-          print "\n## Processing (%s) %s (%d/%d) ##"%(args.slabel,unp,i+(args.ppidx*psize)+1,n)
-          pdbmap.load_unp(unp,label=args.slabel,update=update)
-      # This is a standard, full-set load_unp command
+      # If this task pulls from a shared work queue
+      if args.queue:
+        run_queue(args.queue,"load_unp",all_unp,args.slabel,update,args.workers)
       else:
-        msg = "WARNING (PDBMap) Uploading all %d Swiss-Prot UniProt IDs.\n"%n
-        sys.stderr.write(msg)
-        for i,unp in enumerate(all_unp):
-          print "\n## Processing (%s) %s (%d/%d) ##"%(args.slabel,unp,i,n)
-          pdbmap.load_unp(unp,label=args.slabel,update=update)
+        # If this is a parallel command with partition parameters
+        if args.ppart != None and args.ppidx != None:
+          psize = n / args.ppart # floor
+          if (args.ppart-1) == args.ppidx:
+            all_unp = all_unp[args.ppidx*psize:]
+          else:
+            all_unp = all_unp[args.ppidx*psize:(args.ppidx+1)*psize]
+          msg = "WARNING (PDBMap) Subprocess uploading partition %d/%d of Swiss-Prot\n"%(args.ppidx+1,args.ppart)
+          sys.stderr.write(msg)
+          offset = args.ppidx*psize+1
+        # This is a standard, full-set load_unp command
+        else:
+          msg = "WARNING (PDBMap) Uploading all %d Swiss-Prot UniProt IDs.\n"%n
+          sys.stderr.write(msg)
+          offset = 0
+        jobs = [("load_unp",unp,None,args.slabel,update,i+offset,n) for i,unp in enumerate(all_unp)]
+        run_jobs(jobs,args.workers)
     elif len(args.args) == 1:
       # Process one UniProt ID
       unp = args.args[0]
@@ -717,6 +940,9 @@ __  __  __
       args.slabel = args.slabel if args.slabel else "swiss"
       models = PDBMapSwiss.get_swiss_modelids() # get all  the swiss model unique IDs
       n = len(models)
+      # Fetch all previously loaded models once; skip checks are then local
+      io = PDBMapIO(args.dbhost,args.dbuser,args.dbpass,args.dbname,slabel=args.slabel)
+      print "%d (%s) models already in database."%(io.preload_loaded('Swiss'),args.slabel)
       # If this is a parallel command with partition parameters
       if args.ppart != None and args.ppidx != None:
         psize = n / args.ppart # floor
@@ -758,6 +984,9 @@ __  __  __
       args.slabel = args.slabel if args.slabel else "modbase"
       models = PDBMapModel.get_models() # get all 2013 and 2016 ModBase models
       n = len(models)
+      # Fetch all previously loaded models once; skip checks are then local
+      io = PDBMapIO(args.dbhost,args.dbuser,args.dbpass,args.dbname,slabel=args.slabel)
+      print "%d (%s) models already in database."%(io.preload_loaded('Model'),args.slabel)
       # If this is a parallel command with partition parameters
       if args.ppart != None and args.ppidx != None:
         psize = n / args.ppart # floor
@@ -810,6 +1039,35 @@ __  __  __
             # Load the ModBase model
             pdbmap.load_model(row,label=args.slabel,io=None)
 
+  ## load_transcripts ##
+  elif args.cmd == "load_transcripts":
+    if len(args.args) < 1 or not args.transcript_store:
+      msg  = "usage: pdbmap.py -c conf_file --transcript_store=<file> load_transcripts all\n"
+      msg += "   or: pdbmap.py -c conf_file --transcript_store=<file> load_transcripts enst [enst,...]"
+      print msg; sys.exit(1)
+    if args.args[0] == 'all':
+      pdbmap = PDBMap(idmapping=args.idmapping)
+      transids = set(t for ts in PDBMapProtein._unp2enst.values() for t in ts)
+    else:
+      transids = args.args
+    print "## Storing %d transcripts (Ensembl %s) in %s ##"%(len(set(transids)),
+                                        args.ensembl_release,args.transcript_store)
+    if args.ensembl_gtf and args.ensembl_pep:
+      print " # Mapping from %s and %s"%(args.ensembl_gtf,args.ensembl_pep)
+    nrows = PDBMapTranscript.populate_store(transids,args.workers,args.buffer_size,
+                                            args.ensembl_gtf,args.ensembl_pep)
+    print " # %d transcripts stored (failed queries are retried next run)."%nrows
+
+  ## export_columns ##
+  elif args.cmd == "export_columns":
+    if not (args.slabel and args.column_store):
+      msg  = "usage: pdbmap.py -c conf_file --slabel=<slabel> --column_store=<dir> export_columns"
+      print msg; sys.exit(1)
+    print "## Exporting %s to %s ##"%(args.slabel,args.column_store)
+    io = PDBMapIO(args.dbhost,args.dbuser,args.dbpass,args.dbname,slabel=args.slabel)
+    nrows = io.export_columns()
+    print " # %d residues exported."%nrows
+
   ## load_data ##
   elif args.cmd == "load_data":
     if len(args.args) < 1:
@@ -863,7 +1121,7 @@ __  __  __
   ## intersect ##
   elif args.cmd == "intersect":
     if not (args.slabel and args.dlabel):
-      msg  = "usage: pdbmap.py -c conf_file --slabel=<slabel> --dlabel=<data_name> intersect [quick]\n"
+      msg  = "usage: pdbmap.py -c conf_file --slabel=<slabel> --dlabel=<data_name> intersect [quick|full]\n"
       print msg; sys.exit(1)
     pdbmap = PDBMap()
     dname  = args.dlabel
@@ -873,6 +1131,7 @@ __  __  __
     if slabel == 'all':
       slabel = None
     quick  = True if len(args.args)>0 and args.args[0].lower() in ['1','true','yes','quick','fast'] else False
+    full   = 'full' in [a.lower() for a in args.args]
     # nrows = QUICK_THRESH+1 if len(args.args) < 3 else int(args.args[2])
     if dname and slabel:
       print "## Intersecting %s with %s ##"%(dname,slabel)
@@ -884,7 +1143,7 @@ __  __  __
       print "## Intersecting all genetic datasets with all structures/models ##"
     # quick = True if nrows < QUICK_THRESH else False
     print [" # (This may take a while) #"," # Using quick-intersect #"][int(quick)]
-    nrows = pdbmap.intersect_data(dname,slabel,quick=quick)
+    nrows = pdbmap.intersect_data(dname,slabel,quick=quick,full=full)
     print " # %d intersection rows uploaded."%nrows
 
   ## no command specified ##
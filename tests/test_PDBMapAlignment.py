@@ -0,0 +1,72 @@
+#!/usr/bin/env python2.7
+#
+# Project        : PDBMap
+# Filename       : test_PDBMapAlignment.py
+# Author         : agent
+# Organization   : Center for Human Genetics Research,
+#                : Department of Biomedical Informatics,
+#                : Vanderbilt University Medical Center
+# Email          : agent@local
+# Date           : 2026-10-18
+# Description    : Compares the vectorized global aligner in PDBMapAlignment
+#                : against pairwise2.align.globalds, which it replaces.
+#                : Run from the repository root:
+#                :   python -m unittest discover tests
+#=============================================================================#
+
+import sys,os,new,random,unittest
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from Bio import pairwise2
+from Bio.SubsMat import MatrixInfo as matlist
+from lib.PDBMapAlignment import PDBMapAlignment
+
+AMINO = "ACDEFGHIKLMNPQRSTVWYX"
+
+class TestAlignGlobal(unittest.TestCase):
+
+  gap_open   = -10
+  gap_extend = -0.5
+
+  def setUp(self):
+    # The aligner does not depend on a chain or transcript, so the
+    # (old-style) instance is created without calling __init__
+    self.aligner = new.instance(PDBMapAlignment)
+    self.rand    = random.Random(1)
+
+  def randseq(self,lo,hi,alphabet=AMINO):
+    return ''.join(self.rand.choice(alphabet) for i in range(self.rand.randint(lo,hi)))
+
+  def assertSameAlignment(self,seqA,seqB):
+    ref = pairwise2.align.globalds(seqA,seqB,matlist.blosum62,self.gap_open,
+                                   self.gap_extend,one_alignment_only=True)[0]
+    aln = self.aligner._align_global(seqA,seqB,self.gap_open,self.gap_extend)
+    self.assertEqual(aln,(ref[0],ref[1],ref[2]),"%s vs %s"%(seqA,seqB))
+
+  def test_random(self):
+    for t in range(300):
+      self.assertSameAlignment(self.randseq(1,40),self.randseq(1,40))
+
+  def test_repetitive(self):
+    # Low-complexity sequences have many equally scored alignments
+    for t in range(300):
+      unit  = self.randseq(1,4,"AGS")
+      seqA  = (unit*20)[:self.rand.randint(1,30)]
+      flank = self.randseq(0,6,"AGSX")
+      seqB  = flank + seqA[self.rand.randint(0,len(seqA)-1):] + flank
+      self.assertSameAlignment(seqA,seqB)
+
+  def test_gapped_ends(self):
+    # A chain covering part of a longer transcript
+    for t in range(200):
+      core  = self.randseq(5,30)
+      head  = self.randseq(0,15)
+      tail  = self.randseq(0,15)
+      self.assertSameAlignment(core,head+core+tail)
+      self.assertSameAlignment(head+core,core+tail)
+
+  def test_unscored_residue(self):
+    # Residue codes outside the matrix fall back to pairwise2
+    self.assertEqual(self.aligner._align_global("ACUD","ACD",self.gap_open,self.gap_extend),None)
+
+if __name__ == '__main__':
+  unittest.main()
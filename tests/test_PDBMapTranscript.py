@@ -0,0 +1,63 @@
+#!/usr/bin/env python2.7
+#
+# Project        : PDBMap
+# Filename       : test_PDBMapTranscript.py
+# Author         : agent
+# Organization   : Center for Human Genetics Research,
+#                : Department of Biomedical Informatics,
+#                : Vanderbilt University Medical Center
+# Email          : agent@local
+# Date           : 2026-10-18
+# Description    : Checks PDBMapTranscript.map_from_files against the output
+#                : transcript_to_genomic.pl (Ensembl pep2genomic) gives for
+#                : the plus- and minus-strand transcripts in tests/data.
+#                : Run from the repository root:
+#                :   python -m unittest discover tests
+#=============================================================================#
+
+import sys,os,unittest
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from lib.PDBMapTranscript import PDBMapTranscript
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)),'data')
+
+# transcript_to_genomic.pl reports the first (5') genomic piece of each
+# codon, with an exclusive end.
+# ENST00000000001, chr1 + : CDS 101-107, 201-208; codon 3 is 107|201-202
+PLUS = """ENST00000000001	ENSP00000000001	ENSG00000000001	1	M	101	104	chr1	1
+ENST00000000001	ENSP00000000001	ENSG00000000001	2	K	104	107	chr1	1
+ENST00000000001	ENSP00000000001	ENSG00000000001	3	L	107	108	chr1	1
+ENST00000000001	ENSP00000000001	ENSG00000000001	4	V	203	206	chr1	1
+ENST00000000001	ENSP00000000001	ENSG00000000001	5	A	206	209	chr1	1"""
+
+# ENST00000000002, chr2 - : CDS 507-500, 306-300; codon 3 is 501-500|306
+MINUS = """ENST00000000002	ENSP00000000002	ENSG00000000002	1	M	505	508	chr2	-1
+ENST00000000002	ENSP00000000002	ENSG00000000002	2	P	502	505	chr2	-1
+ENST00000000002	ENSP00000000002	ENSG00000000002	3	Q	500	502	chr2	-1
+ENST00000000002	ENSP00000000002	ENSG00000000002	4	R	303	306	chr2	-1
+ENST00000000002	ENSP00000000002	ENSG00000000002	5	S	300	303	chr2	-1"""
+
+class TestMapFromFiles(unittest.TestCase):
+
+  def map(self,transids):
+    gtf = os.path.join(DATA,"example.gtf")
+    pep = os.path.join(DATA,"example.pep.fa")
+    return dict((t,(s,o)) for t,s,o in PDBMapTranscript.map_from_files(gtf,pep,transids))
+
+  def test_plus_strand(self):
+    self.assertEqual(self.map(["ENST00000000001"])["ENST00000000001"],(0,PLUS))
+
+  def test_minus_strand(self):
+    self.assertEqual(self.map(["ENST00000000002"])["ENST00000000002"],(0,MINUS))
+
+  def test_all_transcripts(self):
+    res = self.map(None)
+    self.assertEqual(sorted(res),["ENST00000000001","ENST00000000002"])
+
+  def test_unknown_transcript(self):
+    status,output = self.map(["ENST00000000009"])["ENST00000000009"]
+    self.assertEqual(status,1)
+    self.assertEqual(output,"Not a valid human transcript ID: ENST00000000009")
+
+if __name__ == '__main__':
+  unittest.main()